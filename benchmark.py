@@ -1,29 +1,61 @@
 #!/usr/bin/env python
 
 import os
-import cPickle as pickle
+import csv
 import datagen
+import json
 import multiprocessing
+import profiles
+import Queue
+import select
 import shlex
 import socket
 import subprocess
 import sys
 import threading
+import telemetry
 import time
 import ConfigParser
 
 from optparse import OptionParser
 from os.path import abspath, expanduser, isfile, dirname, join
 from collections import namedtuple
+from itertools import chain
 
 from memsql.common import database
 
-from cassandra.cluster import Cluster
+from cassandra import DriverException, RequestExecutionException
+from cassandra.cluster import Cluster, NoHostAvailable
+from cassandra.policies import WhiteListRoundRobinPolicy
 from cassandra.query import BatchStatement, SimpleStatement, BatchType
 
 NUM_WORKERS = multiprocessing.cpu_count()
 VERBOSE = False
 
+# Prefixes the line through which a child aggregator hands its
+# detailed statistics to the master as json.
+CHILD_STATS_PREFIX = 'Child stats: '
+
+# Errors an upsert may be retried after. Anything else is a bug in the
+# benchmark and stops the worker.
+RETRYABLE_ERRORS = (database.MySQLError, DriverException,
+                    RequestExecutionException, NoHostAvailable)
+
+# MySQL client errors after which the connection is unusable
+# (server has gone away, lost connection during query)
+DISCONNECT_ERRORS = (2006, 2013)
+
+MAX_RETRY_BACKOFF = 5  # seconds
+
+# In soak mode, every pass over the dataset shifts customer codes by
+# this much so the keys never repeat. It is the largest customer code
+# datagen produces.
+SOAK_KEY_SPACE = 100000
+
+# With --replay-speed, the longest a replayed row waits on later rows to
+# fill its batch.
+REPLAY_WINDOW = 0.1  # seconds
+
 Config = ConfigParser.ConfigParser()
 Config.read('benchmark.cfg')
 
@@ -42,27 +74,49 @@ def vprint(args):
 
 
 class Timer(object):
+    # Wall clock: time.clock() is processor time on Unix, which leaves
+    # out the time spent waiting on the database.
     def __enter__(self): 
-        self.start = time.clock()
+        self.start = time.time()
         return self
 
     def __exit__(self, *args):
-        self.end = time.clock()
+        self.end = time.time()
         self.interval = self.end - self.start
 
 
 
-def get_connection(options, db=''):
-    """ Returns a new connection to the database. """
+def get_connection(options, db='', host=None, port=None):
+    """ Returns a new connection to the database. If host is given,
+        the connection only talks to that host. """
     if options.use_cassandra:
-        cluster = Cluster()
+        if host is None:
+            cluster = Cluster([options.host])
+        else:
+            cluster = Cluster([host], port=port or 9042,
+                              load_balancing_policy=WhiteListRoundRobinPolicy([host]))
         session = cluster.connect()
         setattr(session, "query", lambda s : session.execute(s + ';'))
         return session
     else:
-        return database.connect(host=options.host, port=options.port,
+        return database.connect(host=host or options.host,
+                                port=int(port or options.port),
                                 user=options.user, database=db)
 
+
+def close_connection(options, conn):
+    if options.use_cassandra:
+        conn.cluster.shutdown()
+    else:
+        conn.close()
+
+def discard_connection(options, conn):
+    """ Closes a connection that already failed, ignoring errors. """
+    try:
+        close_connection(options, conn)
+    except Exception:
+        pass
+
 def benchmark_config(section):
     config = {}
     options = Config.options(section)
@@ -83,8 +137,17 @@ def parse_args():
     parser.add_option("--host", default='127.0.0.1')
     parser.add_option("--user", default='root')
     parser.add_option("-p", "--port", default=3306)
-    parser.add_option("--data-file", default=expanduser('~/benchmark/data'),
-                      help='data file to read from')
+    parser.add_option("--data-file", default=None,
+                      help=('data file to read from. Defaults to the '
+                            'catalog entry for the data generator parameters'))
+    parser.add_option("--data-seed", default=1, type="int",
+                      help='seed of the generated dataset')
+    parser.add_option("--num-rows", default=None, type="int",
+                      help=('rows to upsert from each machine. Overrides '
+                            'the count derived from cluster-memory'))
+    parser.add_option("--regenerate-data", action="store_true", default=False,
+                      help=('replace a data file generated with different '
+                            'parameters instead of refusing to run'))
     parser.add_option("--workload-time", default=10)
     parser.add_option("-a", "--aggregator", action="append", dest="aggregators",
                       help=("provide aggregators to run on. if none are "
@@ -93,6 +156,35 @@ def parse_args():
     parser.add_option("-A", "--aggregators-file", 
                       default=[], help='aggregators file to read from',  dest="aggfile")
                       
+    parser.add_option("--pool", action="store_true", default=False,
+                      help=("instead of launching the benchmark on every "
+                            "aggregator, upsert from this process through "
+                            "connections to all of them"))
+    parser.add_option("--balance", choices=["round-robin", "least-outstanding"],
+                      default="round-robin",
+                      help="how --pool spreads batches across aggregators")
+    parser.add_option("--engine", choices=["threaded", "pipelined", "compare"],
+                      default="threaded",
+                      help=("threaded: one synchronous upsert per thread. "
+                            "pipelined: in-flight upserts kept outstanding "
+                            "from a single event loop. compare: run both, "
+                            "one after the other"))
+    parser.add_option("--in-flight", default=16, type="int",
+                      help="upserts the pipelined engine keeps outstanding")
+    parser.add_option("--replay", action="append", dest="replay_files",
+                      default=[],
+                      help=("upsert the rows of this CSV or newline-delimited "
+                            "json trace instead of generated data. Repeat "
+                            "for several files"))
+    parser.add_option("--replay-speed", default=0, type="float",
+                      help=("replay the trace at this multiple of its "
+                            "original pace, by timestamp_of_data. 0 replays "
+                            "as fast as possible"))
+    parser.add_option("--retries", default=3, type="int",
+                      help="times a failed upsert is retried before giving up")
+    parser.add_option("--retry-backoff", default=0.05, type="float",
+                      help=("seconds to wait before the first retry of an "
+                            "upsert. Doubles with every further retry"))
     parser.add_option("--batch-size", default=500)
     parser.add_option("--no-setup", action="store_true", default=False)
     parser.add_option("--mode", choices=["master", "child"],
@@ -104,6 +196,24 @@ def parse_args():
                       help=("How much total memory the cluster has. The "
                             "number of attempted rows to be inserted is a "
                             "function of this"))
+    parser.add_option("--server-metrics-interval", default=0,
+                      help=("Poll server status and table statistics every "
+                            "this many seconds while the workload runs. "
+                            "0 disables polling"))
+    parser.add_option("--metrics-file", default=None,
+                      help=("write the throughput timeline and server "
+                            "metrics to this file as json"))
+    parser.add_option("--profile", choices=sorted(profiles.PROFILES),
+                      default=profiles.DEFAULT_PROFILE,
+                      help=("workload profile (table layout and upsert) to "
+                            "run: %s" % ', '.join(sorted(profiles.PROFILES))))
+    parser.add_option("--soak", action="store_true", default=False,
+                      help=("keep upserting fresh keys beyond the dataset "
+                            "until workload-time elapses or the table reaches "
+                            "soak-memory-fraction of cluster-memory"))
+    parser.add_option("--soak-memory-fraction", default=0.8, type="float",
+                      help=("in soak mode, stop once the table uses this "
+                            "fraction of cluster-memory"))
     parser.add_option("-v", "--verbose", action="store_true", default=False)
     (options, args) = parser.parse_args()
     global VERBOSE
@@ -113,9 +223,43 @@ def parse_args():
     except TypeError:
         sys.stderr.write('workload-time must be an integer')
         exit(1)
+    try:
+        options.server_metrics_interval = float(options.server_metrics_interval)
+    except ValueError:
+        sys.stderr.write('server-metrics-interval must be a number')
+        exit(1)
+    if options.engine != 'threaded' and options.pool:
+        sys.stderr.write('the %s engine talks to --host only and cannot be '
+                         'combined with --pool' % options.engine)
+        exit(1)
+    if options.replay_files and (options.engine != 'threaded' or options.soak):
+        sys.stderr.write('traces are replayed by the threaded engine from a '
+                         'single client, without --soak')
+        exit(1)
+    if options.data_file is None:
+        options.data_file = join(dirname(abspath(__file__)),
+                                 datagen.dataset_name(dataset_params(options)))
+    if options.use_cassandra and \
+            profiles.PROFILES[options.profile].cassandra_ddl is None:
+        sys.stderr.write('the %s profile has no Cassandra equivalent'
+                         % options.profile)
+        exit(1)
+    if options.soak and options.use_cassandra:
+        # Cassandra only reports node-local estimates of a table's size,
+        # which can't tell when the cluster's memory fills up
+        sys.stderr.write('soak mode needs MemSQL; it cannot be combined '
+                         'with -c')
+        exit(1)
+    if options.soak and not options.server_metrics_interval:
+        # soak mode stops on the table size the server reports
+        options.server_metrics_interval = 10
     return options
 
 
+def get_profile(options):
+    return profiles.PROFILES[options.profile]
+
+
 def setup_perf_ks(options):
     with get_connection(options) as conn:
         vprint('Creating keyspace %s' % options.database)
@@ -123,15 +267,9 @@ def setup_perf_ks(options):
                       "{ 'class' : 'SimpleStrategy', 'replication_factor' : 1 } "
                       "and durable_writes = true" % options.database))
         conn.query('use %s' % options.database)
-        create_cmd = ('create table if not exists %s ('
-                      'customer_code int, timestamp_of_data timestamp,'
-                      'subcustomer_id varchar, geographic_region int,'
-                      'billing_flag int, ip_address varchar,'
-                      'hits counter, primary key (timestamp_of_data, '
-                      'customer_code, subcustomer_id, geographic_region, '
-                      'billing_flag, ip_address))') % options.table
-
-        conn.query(create_cmd)
+        vprint('Creating %s table %s' % (options.profile, options.table))
+        for create_cmd in get_profile(options).cassandra_ddl:
+            conn.query(create_cmd % {'table': options.table})
 
 
 def setup_perf_db(options):
@@ -143,22 +281,9 @@ def setup_perf_db(options):
         conn.query('use %s' % options.database)
         conn.query('set global multistatement_transactions = 0')
 
-        vprint('Creating table %s' % options.table)
-
-        create_cmd = ('create table if not exists %s ('
-                      'customer_code int unsigned not null, '
-                      'timestamp_of_data timestamp default current_timestamp, '
-                      'subcustomer_id char(12), '
-                      'geographic_region int unsigned not null, '
-                      'billing_flag int unsigned not null, '
-                      'ip_address char(20), '
-                      'bytes bigint unsigned not null, '
-                      'hits bigint unsigned not null, '
-                      'primary key (timestamp_of_data, customer_code, '
-                      'subcustomer_id, geographic_region, billing_flag, '
-                      'ip_address))') % options.table
-
-        conn.query(create_cmd)
+        vprint('Creating %s table %s' % (options.profile, options.table))
+        for create_cmd in get_profile(options).memsql_ddl:
+            conn.query(create_cmd % {'table': options.table})
 
 
 def setup(options):
@@ -176,11 +301,13 @@ def get_aggregators(options):
     return options.aggregators
     
 
-def convert_cluster_mem_to_num_rows(options):
-    """ Converts the command line arg cluster-memory into
-        the number of rows to upsert. cluster-memory is given
-        in gigabytes. """
-    mem_bytes = int(float(options.cluster_memory) * (1024 ** 3))
+def cluster_memory_bytes(options):
+    return int(float(options.cluster_memory) * (1024 ** 3))
+
+
+def estimated_cost_per_row():
+    """ The number of bytes of cluster memory a row is assumed
+        to take up when sizing the dataset. """
     sample_row = Row(customer_code=56779,
                      timestamp_of_data=1468286020962,
                      subcustomer_id='GMMNLZNRUNEA',
@@ -189,19 +316,62 @@ def convert_cluster_mem_to_num_rows(options):
                      ip_address='119.163.9.26',
                      bytes=1332000, hits=31)
     estimated_db_mem = 136  # discussed offline
-    cost_per_row = sys.getsizeof(sample_row) + estimated_db_mem
-    num_rows = (mem_bytes / cost_per_row) / 2
-    num_machines = len(options.aggregators) + 1
+    return sys.getsizeof(sample_row) + estimated_db_mem
+
+
+def convert_cluster_mem_to_num_rows(options):
+    """ Converts the command line arg cluster-memory into
+        the number of rows to upsert. cluster-memory is given
+        in gigabytes. """
+    if options.num_rows is not None:
+        return options.num_rows
+    mem_bytes = cluster_memory_bytes(options)
+    num_rows = (mem_bytes / estimated_cost_per_row()) / 2
+    # with --pool a single client upserts the whole dataset, spreading
+    # it over the aggregators instead of running on them
+    num_machines = 1 if options.pool else len(options.aggregators) + 1
     return num_rows / num_machines
 
 
+def dataset_params(options):
+    """ The data generator parameters this run asks for. """
+    return dict(datagen.DEFAULT_PARAMS, seed=options.data_seed)
+
+
 def generate_data_file(options):
+    """ Makes sure the data file holds at least as many rows as this
+        run needs, extending it if it is short. Refuses data files
+        generated with other parameters. """
     num_rows = convert_cluster_mem_to_num_rows(options)
-    vprint('Generating test data: {:,} rows'.format(num_rows))
-    if isfile(options.data_file):
-        vprint('Using existing data file: %s' % options.data_file)
+    options.num_rows = num_rows
+    params = dataset_params(options)
+    manifest = datagen.read_manifest(options.data_file)
+
+    if isfile(options.data_file) and manifest is None:
+        print('WARNING: %s has no manifest, so its size and parameters are '
+              'unknown. Using all of it as is' % options.data_file)
+        options.num_rows = None
         return
-    datagen.main(num_rows)
+
+    if manifest is not None and manifest['params'] != params:
+        if not options.regenerate_data:
+            sys.stderr.write('%s was generated with parameters %s, but this '
+                             'run asks for %s. Pass --regenerate-data to '
+                             'replace it\n' % (options.data_file,
+                                                manifest['params'], params))
+            exit(1)
+        print('Regenerating %s' % options.data_file)
+        os.remove(datagen.manifest_path(options.data_file))
+        manifest = None
+
+    have = manifest['num_rows'] if manifest is not None else 0
+    if have >= num_rows:
+        vprint('Using {:,} of the {:,} rows in {}'.format(
+            num_rows, have, options.data_file))
+        return
+    vprint('Generating test data: {:,} rows, {:,} already on disk'.format(
+        num_rows, have))
+    datagen.extend_dataset(options.data_file, num_rows, params)
 
 
 class Analytics(object):
@@ -210,30 +380,129 @@ class Analytics(object):
         self.latency_totals = [0 for _ in xrange(NUM_WORKERS)]
         self.latency_mins = [float("infinity") for _ in xrange(NUM_WORKERS)]
         self.latency_maxs = [0 for _ in xrange(NUM_WORKERS)]
+        # rows upserted by each thread per second, keyed by epoch second
+        # so that the timelines of different hosts line up
+        self.worker_buckets = [{} for _ in xrange(NUM_WORKERS)]
+        # the worker_buckets of child aggregators, by host
+        self.host_buckets = {}
         self.start_time = time.time()
+        self.run_start = None
+        self.run_end = None
+        # upsert threads this process started, whose ids count from 0
+        self.started_threads = 0
         self.last_reported_time = time.time()
         self.last_reported_count = 0
         self.num_records = 0
         self.report_frequency = 100
+        self.client_stats = []
+        self.throughput_timeline = []
+        self.server_samples = []
+        self.endpoint_stats = []
+        self.error_lock = threading.Lock()
+        self.errors = {}
+        self.retried_rows = 0
+        self.failed_rows = 0
+        self.retry_time = 0
+        self.dead_workers = []
 
     def record(self, batch_size, thread_id, latency):
         self.upsert_counts[thread_id] += batch_size
         self.latency_totals[thread_id] += latency
         self.latency_mins[thread_id] = min(latency, self.latency_mins[thread_id])
         self.latency_maxs[thread_id] = max(latency, self.latency_maxs[thread_id])
+        buckets = self.worker_buckets[thread_id]
+        second = int(time.time())
+        buckets[second] = buckets.get(second, 0) + batch_size
         self.num_records += 1
         if self.num_records % self.report_frequency == 0:
             self.continuous_report()
 
+    def record_error(self, error, rows, will_retry):
+        name = error_name(error)
+        with self.error_lock:
+            self.errors[name] = self.errors.get(name, 0) + 1
+            if will_retry:
+                self.retried_rows += rows
+            else:
+                self.failed_rows += rows
+
+    def record_abandoned(self, rows):
+        """ Moves rows whose retry the end of the run cut off from
+            retried to failed. """
+        with self.error_lock:
+            self.retried_rows -= rows
+            self.failed_rows += rows
+
+    def record_retry_time(self, seconds):
+        """ Adds the time a batch lost to failed attempts and backoff. """
+        with self.error_lock:
+            self.retry_time += seconds
+
+    def merge_errors(self, stats):
+        with self.error_lock:
+            for name, count in stats['errors'].items():
+                self.errors[name] = self.errors.get(name, 0) + count
+            self.retried_rows += stats['retried_rows']
+            self.failed_rows += stats['failed_rows']
+            self.retry_time += stats['retry_time']
+            self.dead_workers.extend(stats['dead_workers'])
+
+    def local_buckets(self):
+        """ The worker_buckets of every thread started, empty for those
+            that never got a batch through, so they show up as idle. """
+        return dict((thread_id, self.worker_buckets[thread_id])
+                    for thread_id in xrange(self.started_threads))
+
+    def merge_buckets(self, host, workers):
+        """ Adds a child's worker buckets, as they come out of json. """
+        self.host_buckets[host] = dict(
+            (int(thread_id), dict((int(s), rows) for s, rows in buckets.items()))
+            for thread_id, buckets in workers.items())
+
+    def timelines(self):
+        """ Returns {host: {thread id: {second: rows}}} for this machine
+            and every child aggregator that reported. """
+        timelines = dict(self.host_buckets)
+        if self.local_buckets():
+            timelines[socket.gethostname()] = self.local_buckets()
+        return timelines
+
+    def error_stats(self):
+        return {
+            'errors': self.errors,
+            'retried_rows': self.retried_rows,
+            'failed_rows': self.failed_rows,
+            'retry_time': self.retry_time,
+            'dead_workers': self.dead_workers,
+        }
+
     def continuous_report(self):
         interval = (time.time() - self.last_reported_time)
         self.last_reported_time = time.time()
         cur_total = sum(self.upsert_counts)
         total = cur_total - self.last_reported_count
         self.last_reported_count = cur_total
+        self.throughput_timeline.append((self.last_reported_time, total / interval))
         sys.stdout.write('Current upsert throughput: %d rows / s\n' % (total / interval))
         sys.stdout.flush()
 
+    def summary(self, options):
+        count = sum(self.upsert_counts)
+        return {
+            'rows': count,
+            'rows_per_second': count / self.duration(options),
+            'avg_latency': sum(self.latency_totals) / max(self.num_records, 1),
+            'min_latency': min(self.latency_mins),
+            'max_latency': max(self.latency_maxs),
+        }
+
+    def duration(self, options):
+        """ Seconds the workload ran for on this machine. The master
+            of a distributed run only knows the requested time. """
+        if self.run_start is None or self.run_end is None:
+            return options.workload_time
+        return self.run_end - self.run_start
+
     def update_min(self, latency):
         # Min is associative, so taking first element is fine
         # We only care about the min across the cluster anyway
@@ -249,39 +518,417 @@ class Analytics(object):
 ANALYTICS = Analytics()
 
 
+def error_name(error):
+    """ Names the class of an error, with the MySQL error code if any. """
+    name = type(error).__name__
+    if error.args and isinstance(error.args[0], int):
+        return '%s(%d)' % (name, error.args[0])
+    return name
+
+
+def is_disconnect(error):
+    return (isinstance(error, database.MySQLError) and bool(error.args) and
+            error.args[0] in DISCONNECT_ERRORS)
+
+
+def retry_delay(options, attempt):
+    return min(MAX_RETRY_BACKOFF, options.retry_backoff * 2 ** attempt)
+
+
+def report_dead_worker(worker, exception):
+    worker.exception = exception
+    message = '%s worker %d stopped: %s' % (
+        socket.gethostname(), worker.thread_id, error_name(exception))
+    ANALYTICS.dead_workers.append(message)
+    sys.stderr.write('%s (%s)\n' % (message, exception))
+
+
+class EndpointPool(object):
+    """ Spreads batches over several aggregators (or Cassandra nodes)
+        and keeps throughput and latency statistics for each. Workers
+        acquire an endpoint before each batch and release it after. """
+
+    def __init__(self, options, endpoints, balance):
+        self.options = options
+        self.endpoints = endpoints
+        self.outstanding = [0 for _ in endpoints]
+        self.rows = [0 for _ in endpoints]
+        self.batches = [0 for _ in endpoints]
+        self.latency_totals = [0 for _ in endpoints]
+        self.latency_mins = [float("infinity") for _ in endpoints]
+        self.latency_maxs = [0 for _ in endpoints]
+        self.buckets = [{} for _ in endpoints]
+        self.lock = threading.Lock()
+        self.next_endpoint = 0
+        self.shared_sessions = None
+        if balance == 'least-outstanding':
+            self.acquire = self.acquire_least_outstanding
+        else:
+            self.acquire = self.acquire_round_robin
+
+    def acquire_round_robin(self):
+        with self.lock:
+            idx = self.next_endpoint
+            self.next_endpoint = (idx + 1) % len(self.endpoints)
+            self.outstanding[idx] += 1
+        return idx
+
+    def acquire_least_outstanding(self):
+        with self.lock:
+            idx = min(xrange(len(self.endpoints)),
+                      key=self.outstanding.__getitem__)
+            self.outstanding[idx] += 1
+        return idx
+
+    def release(self, idx, batch_size, latency):
+        """ Ends a batch on endpoint idx. A latency of None means the
+            batch failed. """
+        with self.lock:
+            self.outstanding[idx] -= 1
+            if latency is None:
+                return
+            self.rows[idx] += batch_size
+            self.batches[idx] += 1
+            self.latency_totals[idx] += latency
+            self.latency_mins[idx] = min(latency, self.latency_mins[idx])
+            self.latency_maxs[idx] = max(latency, self.latency_maxs[idx])
+            second = int(time.time())
+            self.buckets[idx][second] = self.buckets[idx].get(second, 0) + batch_size
+
+    def connections(self):
+        """ Returns a connection per endpoint, in endpoint order.
+            Cassandra sessions are thread safe and expensive, so all
+            workers share one per node. """
+        if not self.options.use_cassandra:
+            return [get_connection(self.options, db=self.options.database,
+                                   host=host, port=port)
+                    for host, port in self.endpoints]
+        with self.lock:
+            if self.shared_sessions is None:
+                self.shared_sessions = [
+                    get_connection(self.options, host=host, port=port)
+                    for host, port in self.endpoints]
+        return self.shared_sessions
+
+    def close_connections(self, conns):
+        if not self.options.use_cassandra:
+            [close_connection(self.options, conn) for conn in conns
+             if conn is not None]
+
+    def close(self):
+        if self.shared_sessions is not None:
+            [close_connection(self.options, session)
+             for session in self.shared_sessions]
+
+    def stats(self, duration):
+        return [{
+            'endpoint': '%s:%s' % (host, port) if port else host,
+            'rows': self.rows[i],
+            'rows_per_second': self.rows[i] / duration,
+            'avg_latency': self.latency_totals[i] / max(self.batches[i], 1),
+            'min_latency': self.latency_mins[i] if self.batches[i] else 0,
+            'max_latency': self.latency_maxs[i],
+            'timeline': self.buckets[i],
+        } for i, (host, port) in enumerate(self.endpoints)]
+
+
+def pool_endpoints(options):
+    """ The master aggregator (or Cassandra node) followed by the ones
+        given with -a/-A, as (host, port) pairs. """
+    endpoints = [options.host] + [a.strip() for a in options.aggregators]
+    if options.use_cassandra:
+        # The driver's port, not the MemSQL one, unless one is given
+        return [hostport_from_aggregator(options, e) if ':' in e else (e, None)
+                for e in endpoints]
+    return [hostport_from_aggregator(options, e) for e in endpoints]
+
+
 class InsertWorker(threading.Thread):
     """ A simple thread which inserts generated data in a loop. """
 
-    def __init__(self, stopping, upserts, thread_id, batch_size):
+    def __init__(self, stopping, upserts, thread_id, batch_size, regenerate=None,
+                 pool=None, feed=None):
         super(InsertWorker, self).__init__()
         self.stopping = stopping
         self.daemon = True
         self.exception = None
         self.upserts = upserts
-        self.num_distinct_queries = len(self.upserts)
+        self.num_distinct_queries = len(self.upserts) if upserts is not None else 0
         self.options = options
         self.thread_id = thread_id
         self.batch_size = batch_size
+        # Called with a generation number after every pass over upserts
+        # to get the next pass's queries, if given.
+        self.regenerate = regenerate
+        # With an EndpointPool, every batch goes to the endpoint it picks.
+        self.pool = pool
+        # With a feed, (query, rows) pairs are taken from that queue
+        # instead of upserts, until it yields None.
+        self.feed = feed
 
     def run(self):
+        try:
+            self.upsert_loop()
+        except Exception as e:
+            report_dead_worker(self, e)
+
+    def connect(self, endpoint):
+        if self.pool is None:
+            return get_connection(self.options, db=self.options.database)
+        host, port = self.pool.endpoints[endpoint]
+        return get_connection(self.options, db=self.options.database,
+                              host=host, port=port)
+
+    def execute(self, conns, endpoint, query, rows):
+        """ Runs query, retrying retryable errors with exponential
+            backoff. A lost connection is replaced at the next attempt,
+            and failing to reconnect counts as a failed attempt too.
+            Returns the latency of the attempt that succeeded, or None
+            if the batch failed. """
+        attempt = 0
+        first_try = time.time()
+        while True:
+            try:
+                if conns[endpoint] is None:
+                    conns[endpoint] = self.connect(endpoint)
+                with Timer() as t:
+                    conns[endpoint].execute(query)
+                if attempt:
+                    ANALYTICS.record_retry_time(t.start - first_try)
+                return t.interval
+            except RETRYABLE_ERRORS as e:
+                will_retry = (attempt < self.options.retries and
+                              not self.stopping.is_set())
+                ANALYTICS.record_error(e, rows, will_retry)
+                if conns[endpoint] is not None and is_disconnect(e):
+                    discard_connection(self.options, conns[endpoint])
+                    conns[endpoint] = None
+                if not will_retry:
+                    ANALYTICS.record_retry_time(time.time() - first_try)
+                    return None
+                if self.stopping.wait(retry_delay(self.options, attempt)):
+                    # the run ended while backing off
+                    ANALYTICS.record_abandoned(rows)
+                    ANALYTICS.record_retry_time(time.time() - first_try)
+                    return None
+                attempt += 1
+
+    def upsert_loop(self):
         # This is a hot path. conn.execute releases the GIL,
         # but everything else holds it. The work done outside
         # of the conn.execute call should be minimized, else python
         # becomes the bottleneck of the benchmark.
         count = 0
         batch_size = self.batch_size
-        with get_connection(options, db=self.options.database) as conn:
+        generation = 0
+        pool = self.pool
+        feed = self.feed
+        if pool is None:
+            conns = [self.connect(0)]
+        else:
+            conns = pool.connections()
+        try:
             query_idx = 0
+            endpoint = 0
+            rows = batch_size
             while (not self.stopping.is_set()):
-                with Timer() as t:
-                    conn.execute(self.upserts[query_idx])
-                ANALYTICS.record(batch_size, self.thread_id, t.interval)
-                query_idx = (query_idx + 1) % len(self.upserts)
-                count += batch_size
+                if feed is not None:
+                    try:
+                        item = feed.get(timeout=1)
+                    except Queue.Empty:
+                        continue
+                    if item is None:
+                        feed.put(None)  # so the other workers see the end too
+                        break
+                    query, rows = item
+                else:
+                    query = self.upserts[query_idx]
+                if pool is not None:
+                    endpoint = pool.acquire()
+                latency = self.execute(conns, endpoint, query, rows)
+                if pool is not None:
+                    pool.release(endpoint, rows, latency)
+                if latency is not None:
+                    ANALYTICS.record(rows, self.thread_id, latency)
+                    count += rows
+                if feed is None:
+                    query_idx = (query_idx + 1) % len(self.upserts)
+                    if query_idx == 0 and self.regenerate is not None:
+                        generation += 1
+                        self.upserts = self.regenerate(generation)
+        finally:
+            if pool is None:
+                if conns[0] is not None:
+                    close_connection(self.options, conns[0])
+            else:
+                pool.close_connections(conns)
         if self.thread_id == 1:
             print('')
 
 
+class PipelinedWorker(threading.Thread):
+    """ Keeps in_flight upserts outstanding from a single thread. MemSQL
+        upserts go out over as many non-blocking connections, driven by
+        one select loop; Cassandra upserts go through execute_async on
+        one session. Latency is wall clock time from send to reply. """
+
+    def __init__(self, stopping, upserts, thread_id, batch_size, in_flight,
+                 regenerate=None):
+        super(PipelinedWorker, self).__init__()
+        self.stopping = stopping
+        self.daemon = True
+        self.exception = None
+        self.upserts = upserts
+        self.options = options
+        self.thread_id = thread_id
+        self.batch_size = batch_size
+        self.in_flight = in_flight
+        self.regenerate = regenerate
+        self.query_idx = 0
+        self.generation = 0
+
+    def next_upsert(self):
+        query = self.upserts[self.query_idx]
+        self.query_idx = (self.query_idx + 1) % len(self.upserts)
+        if self.query_idx == 0 and self.regenerate is not None:
+            self.generation += 1
+            self.upserts = self.regenerate(self.generation)
+        return query
+
+    def run(self):
+        try:
+            if self.options.use_cassandra:
+                self.run_cassandra()
+            else:
+                self.run_memsql()
+        except Exception as e:
+            report_dead_worker(self, e)
+
+    def run_memsql(self):
+        batch_size = self.batch_size
+        # One connection per slot, None once lost until the slot's next
+        # send reconnects.
+        conns = [get_connection(self.options, db=self.options.database)
+                 for _ in xrange(self.in_flight)]
+        # memsql's Connection wraps a _mysql connection, whose
+        # send_query and read_query_result split a query so that
+        # waiting for the reply can be left to select.
+        # slot -> (sent at, query, attempt, first tried at)
+        in_flight = {}
+        # slot -> (due at, query, attempt, first tried at) for upserts
+        # waiting to be sent, mostly retries waiting out their backoff
+        deferred = {}
+
+        def send(slot, query, attempt, first_try):
+            now = time.time()
+            first_try = first_try or now
+            try:
+                if conns[slot] is None:
+                    conns[slot] = get_connection(self.options, db=self.options.database)
+                conns[slot]._db.send_query(query)
+            except RETRYABLE_ERRORS as e:
+                failed(slot, e, query, attempt, first_try)
+            else:
+                in_flight[slot] = (now, query, attempt, first_try)
+
+        def failed(slot, error, query, attempt, first_try):
+            will_retry = (attempt < self.options.retries and
+                          not self.stopping.is_set())
+            ANALYTICS.record_error(error, batch_size, will_retry)
+            if conns[slot] is not None and is_disconnect(error):
+                discard_connection(self.options, conns[slot])
+                conns[slot] = None
+            if will_retry:
+                deferred[slot] = (time.time() + retry_delay(self.options, attempt),
+                                  query, attempt + 1, first_try)
+                return
+            ANALYTICS.record_retry_time(time.time() - first_try)
+            if not self.stopping.is_set():
+                # sent from the loop, so a server that keeps failing
+                # can't recurse through send
+                deferred[slot] = (time.time(), self.next_upsert(), 0, None)
+
+        try:
+            for slot in xrange(self.in_flight):
+                send(slot, self.next_upsert(), 0, None)
+            while in_flight or deferred:
+                timeout = 1
+                if deferred:
+                    timeout = max(0, min(d[0] for d in deferred.values()) - time.time())
+                by_fd = dict((conns[slot]._db.fileno(), slot) for slot in in_flight)
+                readable, _, _ = select.select(by_fd.keys(), [], [], timeout)
+                for fd in readable:
+                    slot = by_fd[fd]
+                    sent_at, query, attempt, first_try = in_flight.pop(slot)
+                    try:
+                        conns[slot]._db.read_query_result()
+                    except RETRYABLE_ERRORS as e:
+                        failed(slot, e, query, attempt, first_try)
+                        continue
+                    ANALYTICS.record(batch_size, self.thread_id, time.time() - sent_at)
+                    if attempt:
+                        ANALYTICS.record_retry_time(sent_at - first_try)
+                    if not self.stopping.is_set():
+                        send(slot, self.next_upsert(), 0, None)
+                now = time.time()
+                for slot, (due, query, attempt, first_try) in deferred.items():
+                    if self.stopping.is_set():
+                        del deferred[slot]
+                        if attempt:
+                            # abandoned before its retry came up
+                            ANALYTICS.record_abandoned(batch_size)
+                            ANALYTICS.record_retry_time(now - first_try)
+                    elif due <= now:
+                        del deferred[slot]
+                        send(slot, query, attempt, first_try)
+        finally:
+            [close_connection(self.options, conn) for conn in conns
+             if conn is not None]
+
+    def run_cassandra(self):
+        batch_size = self.batch_size
+        slots = threading.Semaphore(self.in_flight)
+
+        def submit(query, attempt, first_try):
+            sent_at = time.time()
+            future = session.execute_async(query)
+            future.add_callbacks(done, failed,
+                                 callback_args=(sent_at, attempt, first_try or sent_at),
+                                 errback_args=(query, attempt, first_try or sent_at))
+
+        def done(_, sent_at, attempt, first_try):
+            ANALYTICS.record(batch_size, self.thread_id, time.time() - sent_at)
+            if attempt:
+                ANALYTICS.record_retry_time(sent_at - first_try)
+            slots.release()
+
+        def failed(exception, query, attempt, first_try):
+            will_retry = (isinstance(exception, RETRYABLE_ERRORS) and
+                          attempt < self.options.retries and
+                          not self.stopping.is_set())
+            ANALYTICS.record_error(exception, batch_size, will_retry)
+            if will_retry:
+                # the batch keeps its slot while it backs off
+                retry = threading.Timer(retry_delay(self.options, attempt), submit,
+                                        args=(query, attempt + 1, first_try))
+                retry.daemon = True
+                retry.start()
+            else:
+                ANALYTICS.record_retry_time(time.time() - first_try)
+                slots.release()
+
+        session = get_connection(self.options)
+        try:
+            while not self.stopping.is_set():
+                slots.acquire()
+                submit(self.next_upsert(), 0, None)
+            # wait for the upserts still in flight
+            for _ in xrange(self.in_flight):
+                slots.acquire()
+        finally:
+            close_connection(self.options, session)
+
+
 def warmup(options):
     vprint('Warming up workload')
     if options.use_cassandra: return
@@ -290,28 +937,27 @@ def warmup(options):
         conn.execute('set global multistatement_transactions = 0;')
 
 
-def get_cassandra_queries(options, batch_size):
+def load_rows(options):
+    print('Deserializing data')
+    return [Row(*t) for t in datagen.load_rows(options.data_file,
+                                                options.num_rows)]
 
-    with open(options.data_file, 'r') as f:
-        print('Deserializing data')
-        rows = [Row(*t) for t in pickle.load(f)]
 
-    prefix = 'update %s.%s set hits = hits + 1 ' % (options.database, options.table)
+def get_cassandra_queries(options, batch_size, rows=None):
 
-    primary_key_cols = ['timestamp_of_data', 'customer_code', 'subcustomer_id',
-                        'geographic_region', 'billing_flag', 'ip_address']
+    if rows is None:
+        rows = load_rows(options)
 
-    updates = []
-    for row in rows:
-        update = prefix + 'where ' + ' and '.join(['%s=%r' %
-            (name, getattr(row, name)) for name in primary_key_cols]) + ';'
-        updates.append(update)
+    profile = get_profile(options)
+    updates = [profile.cassandra_update(options.database, options.table, row)
+               for row in rows]
 
     batches = [updates[i:i+batch_size] for i in xrange(0, len(updates), batch_size)]
 
+    batch_type = getattr(BatchType, profile.cassandra_batch_type)
     batch_objects = []
     for batch in batches:
-        batch_object = BatchStatement(batch_type=BatchType.COUNTER)
+        batch_object = BatchStatement(batch_type=batch_type)
         for update in batch:
             batch_object.add(SimpleStatement(update))
         batch_objects.append(batch_object)
@@ -319,46 +965,37 @@ def get_cassandra_queries(options, batch_size):
     return batch_objects
 
 
-def format_row(row):
-    return '(%r, %r, %r, %r, %r, %r, %r)' % (
-        row.customer_code,
-        row.subcustomer_id,
-        row.geographic_region,
-        row.billing_flag,
-        row.ip_address,
-        row.bytes,
-        row.hits
-    )
+def format_row(row, profile):
+    return '(%s)' % ', '.join('%r' % value for value in profile.values(row))
 
 
-def format_query(options, rows):
-    prefix = ('insert into %s (customer_code, subcustomer_id, '
-              'geographic_region, billing_flag, ip_address, bytes, hits) '
-              'values ') % options.table
+def query_affixes(options):
+    """ Returns the text around the values of a MemSQL upsert. """
+    profile = get_profile(options)
+    prefix = 'insert into %s (%s) values ' % (
+        options.table, ', '.join(profile.memsql_columns))
+    postfix = ' ' + profile.memsql_update if profile.memsql_update else ''
+    return prefix, postfix
 
-    postfix = (' on duplicate key update bytes = values(bytes) + bytes, '
-               'hits = values(hits) + hits')
 
-    return prefix + ','.join([format_row(row) for row in rows]) + postfix
+def format_query(options, rows):
+    prefix, postfix = query_affixes(options)
+    profile = get_profile(options)
+    return prefix + ','.join([format_row(row, profile) for row in rows]) + postfix
 
 
-def get_queries(options, batch_size):
+def get_queries(options, batch_size, rows=None):
 
-    with open(options.data_file, 'r') as f:
-        rows = []
-        print('Deserializing data')
-        rows = [format_row(Row(*row)) for row in pickle.load(f)]
+    if rows is None:
+        rows = load_rows(options)
+    profile = get_profile(options)
+    rows = [format_row(row, profile) for row in rows]
 
     batches = [rows[i:i+batch_size] for i in xrange(0, len(rows), batch_size)]
     for batch in batches:
         batch.sort()
 
-    prefix = ('insert into %s (customer_code, subcustomer_id, '
-              'geographic_region, billing_flag, ip_address, bytes, hits) '
-              'values ') % options.table
-
-    postfix = (' on duplicate key update bytes = values(bytes) + bytes, '
-               'hits = values(hits) + hits')
+    prefix, postfix = query_affixes(options)
 
     return [prefix + ','.join(batch) + postfix for batch in batches]
 
@@ -367,28 +1004,269 @@ def on_master_agg(options):
     return options.mode == 'master'
 
 
-def run_benchmark(options):
-    """ Run a set of InsertWorkers and record their performance. """
+TRACE_INT_FIELDS = set(['customer_code', 'timestamp_of_data', 'geographic_region',
+                        'billing_flag', 'bytes', 'hits'])
+
+
+def trace_row(values):
+    """ Builds a Row from the values of a trace record, in Row order. """
+    return Row(*[int(float(value)) if name in TRACE_INT_FIELDS else str(value)
+                 for name, value in zip(Row._fields, values)])
+
+
+def iter_trace_rows(paths):
+    """ Streams Rows out of CSV and newline-delimited json trace files.
+        CSV files may start with a header naming the Row fields; without
+        one, columns are taken to be in Row order. """
+    for path in paths:
+        with open(path, 'r') as f:
+            if path.endswith(('.json', '.jsonl', '.ndjson')):
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        yield trace_row([record[name] for name in Row._fields])
+            else:
+                reader = csv.reader(f)
+                order = None
+                for values in reader:
+                    if order is None:
+                        if set(Row._fields) <= set(values):
+                            order = [values.index(name) for name in Row._fields]
+                            continue
+                        order = range(len(Row._fields))
+                    if values:
+                        yield trace_row([values[i] for i in order])
+
+
+class ReplayReader(threading.Thread):
+    """ Streams a trace into a bounded queue of (query, rows) pairs for
+        InsertWorkers, so the trace is never held in memory. With a speed,
+        each batch is released when its last row would have arrived,
+        at that multiple of the trace's pace, and a batch is cut short
+        rather than hold its first row more than REPLAY_WINDOW seconds.
+        Puts None at the end. """
+
+    def __init__(self, options, batch_size, feed, stopping):
+        super(ReplayReader, self).__init__()
+        self.daemon = True
+        self.options = options
+        self.batch_size = batch_size
+        self.feed = feed
+        self.stopping = stopping
+        self.speed = options.replay_speed
+        self.rows = 0
+        self.max_lag = 0
+
+    def put(self, item):
+        """ Returns False if the run stopped before item fit in. """
+        while not self.stopping.is_set():
+            try:
+                self.feed.put(item, timeout=1)
+                return True
+            except Queue.Full:
+                continue
+        return False
+
+    def due(self, row):
+        """ When row would arrive at the replay speed. """
+        if self.first_timestamp is None:
+            self.first_timestamp = row.timestamp_of_data
+            self.replay_start = time.time()
+        return self.replay_start + (row.timestamp_of_data -
+                                    self.first_timestamp) / (1000.0 * self.speed)
+
+    def send(self, batch, due):
+        """ Queues batch once due, returning False if the run stopped. """
+        if self.speed:
+            delay = due - time.time()
+            self.max_lag = max(self.max_lag, -delay)
+            if delay > 0 and self.stopping.wait(delay):
+                return False
+        query = self.make_queries(self.options, len(batch), rows=batch)[0]
+        if not self.put((query, len(batch))):
+            return False
+        self.rows += len(batch)
+        return True
 
-    batch_size = 500
-    if options.use_cassandra:
-        upserts = get_cassandra_queries(options, batch_size)
-    else:
-        upserts = get_queries(options, batch_size)
+    def run(self):
+        options = self.options
+        self.make_queries = (get_cassandra_queries if options.use_cassandra
+                             else get_queries)
+        self.first_timestamp = self.replay_start = None
+        batch = []
+        due = cutoff = None
+        try:
+            for row in iter_trace_rows(options.replay_files):
+                if self.speed:
+                    next_due = self.due(row)
+                    if batch and next_due > cutoff:
+                        # don't hold what has arrived for a row that hasn't
+                        if not self.send(batch, due):
+                            return
+                        batch = []
+                    if not batch:
+                        cutoff = max(next_due, time.time()) + REPLAY_WINDOW
+                    due = next_due
+                batch.append(row)
+                if len(batch) == self.batch_size:
+                    if not self.send(batch, due):
+                        return
+                    batch = []
+            if batch:
+                self.send(batch, due)
+        finally:
+            self.put(None)
+
+
+def soak_regenerator(options, rows, batch_size):
+    """ Returns a regenerate callback for an InsertWorker that
+        upserts the given rows, with their customer codes moved to a
+        range no earlier generation has used. The upserts are formatted
+        once, with a %d in place of every customer code, so a new pass
+        only substitutes the shifted codes. """
+    profile = get_profile(options)
+    key = profile.memsql_columns.index('customer_code')
+    prefix, postfix = query_affixes(options)
+    templates = []
+    for i in xrange(0, len(rows), batch_size):
+        batch = []
+        for row in rows[i:i+batch_size]:
+            values = ['%r' % value for value in profile.values(row)]
+            text = '(%s)' % ', '.join(values)
+            values = [value.replace('%', '%%') for value in values]
+            values[key] = '%d'
+            # sort on the formatted row to keep the order get_queries uses
+            batch.append((text, '(%s)' % ', '.join(values), row.customer_code))
+        batch.sort()
+        template = (prefix.replace('%', '%%') +
+                    ','.join(pattern for _, pattern, _ in batch) +
+                    postfix.replace('%', '%%'))
+        templates.append((template, [code for _, _, code in batch]))
 
-    stopping = threading.Event()
-    workers = [InsertWorker(stopping, upserts[i::NUM_WORKERS], i, batch_size)
-               for i in xrange(NUM_WORKERS)]
+    def regenerate(generation):
+        offset = generation * SOAK_KEY_SPACE
+        return [template % tuple([code + offset for code in codes])
+                for template, codes in templates]
+    return regenerate
 
-    print('Launching %d workers with batch size of %d' % (NUM_WORKERS, batch_size))
 
+class SoakMonitor(threading.Thread):
+    """ Ends a soak run once the table reported by the server metrics
+        collector reaches the configured share of cluster memory. """
+
+    def __init__(self, options, collector, stopping):
+        super(SoakMonitor, self).__init__()
+        self.daemon = True
+        self.collector = collector
+        self.stopping = stopping
+        self.limit = options.soak_memory_fraction * cluster_memory_bytes(options)
+        self.interval = options.server_metrics_interval
+
+    def run(self):
+        seen = 0
+        while not self.stopping.wait(self.interval):
+            samples = self.collector.samples
+            if len(samples) == seen:
+                continue
+            seen = len(samples)
+            latest = samples[-1]
+            vprint('Table holds {:,} rows in {:,} bytes'.format(
+                latest['rows'], int(latest['memory'])))
+            if latest['memory'] >= self.limit:
+                print('Table reached {:,} bytes, ending soak run'.format(
+                    int(latest['memory'])))
+                self.stopping.set()
+
+
+def run_benchmark(options, collector=None):
+    """ Run a set of InsertWorkers and record their performance. """
+
+    batch_size = 500
+    stopping = threading.Event()
+    reader = feed = rows = upserts = None
+    if options.replay_files:
+        feed = Queue.Queue(maxsize=4 * NUM_WORKERS)
+        reader = ReplayReader(options, batch_size, feed, stopping)
+        print('Replaying %s' % ', '.join(options.replay_files))
+    else:
+        rows = load_rows(options)
+        if options.use_cassandra:
+            upserts = get_cassandra_queries(options, batch_size, rows=rows)
+        else:
+            upserts = get_queries(options, batch_size, rows=rows)
+
+    regenerators = [None] * NUM_WORKERS
+    if options.soak:
+        # Worker i runs batches i, i + NUM_WORKERS, ... so give it the
+        # rows of exactly those batches to generate fresh keys from.
+        batches = [rows[i:i+batch_size] for i in xrange(0, len(rows), batch_size)]
+        regenerators = [soak_regenerator(options,
+                                         list(chain(*batches[i::NUM_WORKERS])),
+                                         batch_size)
+                        for i in xrange(NUM_WORKERS)]
+    pool = None
+    if options.pool:
+        pool = EndpointPool(options, pool_endpoints(options), options.balance)
+        print('Spreading batches over %d endpoints (%s)'
+              % (len(pool.endpoints), options.balance))
+    if options.engine == 'pipelined':
+        regenerate = None
+        if options.soak:
+            regenerate = soak_regenerator(options, rows, batch_size)
+        workers = [PipelinedWorker(stopping, upserts, 0, batch_size,
+                                   options.in_flight, regenerate=regenerate)]
+        print('Launching a pipelined worker with %d upserts in flight, '
+              'batch size of %d on the %s profile'
+              % (options.in_flight, batch_size, options.profile))
+    else:
+        workers = [InsertWorker(stopping,
+                                upserts[i::NUM_WORKERS] if feed is None else None,
+                                i, batch_size, regenerate=regenerators[i],
+                                pool=pool, feed=feed)
+                   for i in xrange(NUM_WORKERS)]
+        print('Launching %d workers with batch size of %d on the %s profile'
+              % (NUM_WORKERS, batch_size, options.profile))
+
+    # Threaded workers build their batches in python, and so do the
+    # Cassandra driver's callbacks, so the GIL holds either database's
+    # client to about one core. The pipelined engine leaves its waiting
+    # and I/O to select or the driver's event loop.
+    if options.engine == 'pipelined':
+        cpu_limit = multiprocessing.cpu_count()
+    else:
+        cpu_limit = telemetry.GIL_CORES
+    sampler = telemetry.ClientSampler(cpu_limit=cpu_limit)
+    sampler.start()
+    if options.soak and collector is not None:
+        SoakMonitor(options, collector, stopping).start()
+    ANALYTICS.run_start = time.time()
+    if reader is not None:
+        reader.start()
+    ANALYTICS.started_threads = len(workers)
     [worker.start() for worker in workers]
-    time.sleep(options.workload_time)
+    # Runs end early when a trace runs out or all workers are gone
+    deadline = ANALYTICS.run_start + options.workload_time
+    while not stopping.wait(max(0, min(1, deadline - time.time()))):
+        if time.time() >= deadline or not any(w.is_alive() for w in workers):
+            break
 
     vprint('Stopping workload')
 
     stopping.set()
     [worker.join() for worker in workers]
+    ANALYTICS.run_end = time.time()
+    sampler.stop()
+    if pool is not None:
+        pool.close()
+        ANALYTICS.endpoint_stats = pool.stats(ANALYTICS.duration(options))
+    if reader is not None:
+        print('Replayed {:,} rows'.format(reader.rows))
+        if options.replay_speed and reader.max_lag > 1:
+            print('WARNING: the replay fell up to %.1f s behind the trace' %
+                  reader.max_lag)
+    client_summary = sampler.summary()
+    if client_summary is not None:
+        ANALYTICS.client_stats.append(client_summary)
 
 
 def cleanup(options):
@@ -460,7 +1338,11 @@ def scp_myself_to_all_aggs(options):
 
         # Copy python scripts to all aggregators
         
-        for f in [options.data_file, abspath(__file__), abspath(datagen.__file__)]:
+        data_files = [options.data_file]
+        if isfile(datagen.manifest_path(options.data_file)):
+            data_files.append(datagen.manifest_path(options.data_file))
+        for f in data_files + [abspath(__file__), abspath(datagen.__file__),
+                               abspath(telemetry.__file__), abspath(profiles.__file__)]:
             cmd = shlex.split(copy_cmd % expanduser(f))
             subprocess.Popen(cmd, stdout=subprocess.PIPE).wait()
 
@@ -480,8 +1362,16 @@ def run_on_all_aggs(options):
         remote_cmd += ' -c' if options.use_cassandra else ''
         remote_cmd += ' --database=%s' % options.database
         remote_cmd += ' --table=%s' % options.table
+        remote_cmd += ' --profile=%s' % options.profile
+        remote_cmd += ' --engine=%s' % options.engine
+        remote_cmd += ' --in-flight=%s' % options.in_flight
+        remote_cmd += ' --retries=%s' % options.retries
+        remote_cmd += ' --retry-backoff=%s' % options.retry_backoff
         remote_cmd += ' --port=%s' % agg_port
         remote_cmd += ' --data-file=%s' % options.data_file
+        remote_cmd += ' --data-seed=%s' % options.data_seed
+        if options.num_rows is not None:
+            remote_cmd += ' --num-rows=%s' % options.num_rows
         remote_cmd += ' --workload-time=%s' % options.workload_time
         remote_cmd += ' --cluster-memory=%s' % options.cluster_memory
 
@@ -520,10 +1410,86 @@ def report(options, child_aggs_total=0):
     max_latency = max(ANALYTICS.latency_maxs)
 
     print('{:,} rows in total'.format(total_count))
-    print("{:,} rows per second".format(total_count / options.workload_time))
+    print("{:,} rows per second".format(
+        int(total_count / ANALYTICS.duration(options))))
     print('Min query latency: %.3f ms' % (1000 * min_latency))
     print('Max query latency: %.3f ms' % (1000 * max_latency))
 
+    if ANALYTICS.errors or ANALYTICS.dead_workers:
+        print('Errors:')
+        for name, count in sorted(ANALYTICS.errors.items()):
+            print('    {}: {:,}'.format(name, count))
+        print('{:,} rows retried, {:,} rows failed, {:.1f} s lost to retries'.format(
+            ANALYTICS.retried_rows, ANALYTICS.failed_rows, ANALYTICS.retry_time))
+        for message in ANALYTICS.dead_workers:
+            print('WARNING: %s' % message)
+
+    if ANALYTICS.endpoint_stats:
+        print('Per endpoint:')
+        for stats in ANALYTICS.endpoint_stats:
+            print('{}: {:,} rows, {:,} rows per second, latency avg {:.3f} ms, '
+                  'min {:.3f} ms, max {:.3f} ms'.format(
+                      stats['endpoint'], stats['rows'],
+                      int(stats['rows_per_second']),
+                      1000 * stats['avg_latency'], 1000 * stats['min_latency'],
+                      1000 * stats['max_latency']))
+
+    report_fairness()
+
+    if ANALYTICS.client_stats:
+        print('Client telemetry:')
+        for summary in ANALYTICS.client_stats:
+            print(telemetry.format_client_summary(summary))
+        saturated = [s['host'] for s in ANALYTICS.client_stats if s['saturation']]
+        if saturated:
+            print('WARNING: the client was saturated on %s; throughput may be '
+                  'bounded by the benchmark rather than the database'
+                  % ', '.join(saturated))
+
+    if ANALYTICS.server_samples:
+        print('Server metrics:')
+        print(telemetry.format_server_timeline(ANALYTICS.server_samples,
+                                               ANALYTICS.throughput_timeline,
+                                               ANALYTICS.start_time))
+
+    if options.soak and ANALYTICS.server_samples:
+        latest = ANALYTICS.server_samples[-1]
+        if latest['rows']:
+            print('Measured %.1f bytes per row (dataset sizing assumes %d)' % (
+                latest['memory'] / float(latest['rows']), estimated_cost_per_row()))
+        print('Throughput against table size:')
+        print(telemetry.format_growth_plot(ANALYTICS.server_samples,
+                                           ANALYTICS.throughput_timeline))
+
+
+def report_fairness():
+    """ Prints throughput over time per host, worker thread and
+        endpoint, with how evenly it was spread and who lagged. """
+    timelines = ANALYTICS.timelines()
+    if len(timelines) > 1:
+        host_timelines = []
+        for host, workers in sorted(timelines.items()):
+            total = {}
+            for buckets in workers.values():
+                for second, rows in buckets.items():
+                    total[second] = total.get(second, 0) + rows
+            host_timelines.append((host, total))
+        print('Per host:')
+        print(telemetry.format_timelines(host_timelines))
+
+    worker_timelines = [('%s/%d' % (host, thread_id), buckets)
+                        for host, workers in sorted(timelines.items())
+                        for thread_id, buckets in sorted(workers.items())]
+    if worker_timelines:
+        print('Per worker:')
+        print(telemetry.format_timelines(worker_timelines))
+
+    if len(ANALYTICS.endpoint_stats) > 1:
+        print('Per endpoint over time:')
+        print(telemetry.format_timelines(
+            [(stats['endpoint'], stats['timeline'])
+             for stats in ANALYTICS.endpoint_stats]))
+
 
 def child_agg_report(options):
     count = sum(ANALYTICS.upsert_counts)
@@ -533,18 +1499,113 @@ def child_agg_report(options):
     max_latency = max(ANALYTICS.latency_maxs)
 
     print('{:,} rows in total'.format(count))
-    print("{:,} rows per second".format(count / options.workload_time))
+    print("{:,} rows per second".format(int(count / ANALYTICS.duration(options))))
+    # Several aggregators can share a machine, so the master tells
+    # children apart by the aggregator they upsert into.
+    host = '%s:%s' % (socket.gethostname(), options.port)
+    for summary in ANALYTICS.client_stats:
+        summary['host'] = host
+    # Must come before the latency lines, after which the master
+    # stops reading from this child.
+    stats = {
+        'client_stats': ANALYTICS.client_stats,
+        'host': host,
+        'timeline': ANALYTICS.local_buckets(),
+    }
+    stats.update(ANALYTICS.error_stats())
+    print(CHILD_STATS_PREFIX + json.dumps(stats))
     print('Min query latency: %f s' % (min_latency))
     print('Max query latency: %f s' % (max_latency))
 
+def start_server_metrics(options):
+    """ Starts polling the server if asked to. Returns the collector,
+        or None. """
+    if not options.server_metrics_interval:
+        return None
+    collector = telemetry.ServerMetricsCollector(
+        lambda: get_connection(options, db=options.database),
+        options.use_cassandra, options.database, options.table,
+        options.server_metrics_interval)
+    collector.start()
+    return collector
+
+
+def stop_server_metrics(options, collector):
+    if collector is None:
+        return
+    collector.stop()
+    ANALYTICS.server_samples = collector.samples
+    if options.metrics_file:
+        with open(options.metrics_file, 'w') as f:
+            json.dump({
+                'start_time': ANALYTICS.start_time,
+                'throughput': ANALYTICS.throughput_timeline,
+                'server': ANALYTICS.server_samples,
+                'workers': ANALYTICS.timelines(),
+                'endpoints': dict((stats['endpoint'], stats['timeline'])
+                                  for stats in ANALYTICS.endpoint_stats),
+            }, f)
+
+
+def compare_engines(options, collector):
+    """ Runs the workload with each engine in turn and reports them
+        side by side, including rows per second per client core. """
+    global ANALYTICS
+    results = []
+    for engine in ['threaded', 'pipelined']:
+        options.engine = engine
+        ANALYTICS = Analytics()
+        run_benchmark(options, collector=collector)
+        print('== %s engine ==' % engine)
+        report(options)
+        summary = ANALYTICS.summary(options)
+        client = ANALYTICS.client_stats[0] if ANALYTICS.client_stats else None
+        summary['per_core'] = (summary['rows_per_second'] / client['avg_cpu']
+                               if client and client['avg_cpu'] else None)
+        results.append((engine, summary))
+    options.engine = 'compare'
+    stop_server_metrics(options, collector)
+
+    print('%-10s %14s %14s %12s %12s %12s' % ('engine', 'rows/s', 'rows/s/core',
+                                              'avg ms', 'min ms', 'max ms'))
+    for engine, summary in results:
+        per_core = summary['per_core']
+        print('%-10s %14s %14s %12.3f %12.3f %12.3f' % (
+            engine, '{:,}'.format(int(summary['rows_per_second'])),
+            '{:,}'.format(int(per_core)) if per_core is not None else '-',
+            1000 * summary['avg_latency'], 1000 * summary['min_latency'],
+            1000 * summary['max_latency']))
+
+
 def master_aggregator_main(options):
+    # Checked here rather than in parse_args, once -A has added its
+    # aggregators
+    if options.soak and options.aggregators and not options.pool:
+        sys.stderr.write('soak mode runs from a single client; '
+                         'use --pool or drop the aggregator flags')
+        exit(1)
+    if options.engine == 'compare' and options.aggregators:
+        sys.stderr.write('compare the engines on a single client')
+        exit(1)
+    if options.replay_files and options.aggregators and not options.pool:
+        sys.stderr.write('traces are replayed from a single client; '
+                         'use --pool or drop the aggregator flags')
+        exit(1)
+    collector = None
     try:
         if not options.no_setup:
             setup(options)
             warmup(options)
-            generate_data_file(options)
+            if not options.replay_files:
+                generate_data_file(options)
+        else:
+            # the data file is used as is, but only as much of it as
+            # --cluster-memory asks for
+            options.num_rows = convert_cluster_mem_to_num_rows(options)
+
+        collector = start_server_metrics(options)
 
-        if options.aggregators:
+        if options.aggregators and not options.pool:
             if not options.no_setup:
                 vprint('Distributing files to all machines')
                 scp_myself_to_all_aggs(options)
@@ -569,23 +1630,37 @@ def master_aggregator_main(options):
                         cur_upsert_rates.append(extract_upsert(line))
                     if line.strip().endswith('rows') and 'inserted' in line:
                         child_aggs_total += int(line.split(' ')[-2])
+                    if line.startswith(CHILD_STATS_PREFIX):
+                        child_stats = json.loads(line[len(CHILD_STATS_PREFIX):])
+                        ANALYTICS.client_stats.extend(child_stats['client_stats'])
+                        ANALYTICS.merge_errors(child_stats)
+                        ANALYTICS.merge_buckets(child_stats['host'],
+                                                child_stats['timeline'])
                     if 'Min query latency' in line:
                         ANALYTICS.update_min(extract_latency(line))
                     if 'Max query latency' in line:
                         ANALYTICS.update_max(extract_latency(line))
                         num_done += 1
                 if sum(cur_upsert_rates) > 0:
+                    ANALYTICS.throughput_timeline.append(
+                        (time.time(), sum(cur_upsert_rates)))
                     sys.stdout.write('Current upsert: {:,} rows per sec\r'.format(sum(cur_upsert_rates)))
             print('')
 
             [p.wait() for p in processes]
+            stop_server_metrics(options, collector)
             report(options, child_aggs_total=child_aggs_total)
+        elif options.engine == 'compare':
+            compare_engines(options, collector)
         else:
-            run_benchmark(options)
+            run_benchmark(options, collector=collector)
+            stop_server_metrics(options, collector)
             report(options)
     except KeyboardInterrupt:
         print("Interrupted... exiting...")
     finally:
+        if collector is not None:
+            collector.stop()
         if options.drop_database:
             cleanup(options)
 
@@ -594,6 +1669,8 @@ def child_aggregator_main(options):
     if not options.no_setup:
         generate_data_file(options)
         warmup(options)
+    else:
+        options.num_rows = convert_cluster_mem_to_num_rows(options)
     run_benchmark(options)
     child_agg_report(options)
 
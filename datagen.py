@@ -5,8 +5,12 @@ import time
 import string
 import random
 import sys
-import pickle
-from os.path import abspath, dirname, join
+import cPickle as pickle
+import hashlib
+import json
+import numpy.random
+import os
+from os.path import abspath, dirname, isfile, join
 from numpy.random import pareto, permutation
 from collections import namedtuple
 
@@ -83,18 +87,40 @@ Row = namedtuple('Row', ['customer_code', 'timestamp_of_data',
     'ip_address', 'bytes', 'hits'])
 
 
-def main(scale_factor=100000):
+# Everything that shapes a dataset. Datasets generated with the same
+# parameters are interchangeable and can be extended by each other.
+DEFAULT_PARAMS = {
+    'max_customer_code': 100000,
+    'num_geographic_regions': 10,
+    'num_billing_flags': 5,
+    'num_ip_addrs': 10000,
+    'subcustomer_id_length': 12,
+    'seed': 1,
+}
+
+
+def seed_all(seed):
+    random.seed(seed)
+    numpy.random.seed(hash(seed) & 0xffffffff)
+
+
+def generate_rows(num_rows, params=DEFAULT_PARAMS, offset=0):
     """ Customer_codes and subcustomer_ids are drawn from a
         pareto approximation. Every other column is drawn
-        uniformly at random. """
+        uniformly at random.
+
+        The mappings that make the data look real depend only on the
+        seed. Rows are drawn from a stream picked by the seed and
+        offset, so rows generated later to extend a dataset follow
+        the same distribution as the ones before them. """
 
-    max_customer_code = 100000
-    num_geographic_regions = 10
-    num_billing_flags = 5
-    max_hits = 50
-    num_ip_addrs = 10000
+    max_customer_code = params['max_customer_code']
+    num_geographic_regions = params['num_geographic_regions']
+    num_billing_flags = params['num_billing_flags']
+    num_ip_addrs = params['num_ip_addrs']
+    subcustomer_id_length = params['subcustomer_id_length']
 
-    subcustomer_id_length = 12
+    seed_all(params['seed'])
     letters = permutation(list(string.uppercase))
 
     user_ips = gen_ip_addrs(num_ip_addrs)
@@ -112,7 +138,8 @@ def main(scale_factor=100000):
 
     rows = []
 
-    for _ in print_progress_of(xrange(scale_factor)):
+    seed_all((params['seed'], offset))
+    for _ in print_progress_of(xrange(num_rows)):
 
         row_customer_code = rand_customer()
         row_timestamp_of_data = int(1000 * time.time())
@@ -134,12 +161,67 @@ def main(scale_factor=100000):
 
         rows.append(tuple(row))
     # rows.sort()
+    return rows
+
+
+def dataset_name(params=DEFAULT_PARAMS):
+    """ The catalog name of the dataset generated with params. """
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True)).hexdigest()
+    return 'data-%s' % digest[:12]
+
+
+def manifest_path(path):
+    return path + '.manifest'
 
-    path = join(dirname(abspath(__file__)), 'data')
+
+def read_manifest(path):
+    """ Returns the manifest of the dataset at path, or None if the
+        dataset has none (or doesn't exist). """
+    if not isfile(manifest_path(path)):
+        return None
+    with open(manifest_path(path), 'r') as f:
+        return json.load(f)
+
+
+def write_manifest(path, params, num_rows):
+    tmp_path = manifest_path(path) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'params': params, 'num_rows': num_rows}, f)
+    os.rename(tmp_path, manifest_path(path))
+
+
+def extend_dataset(path, num_rows, params=DEFAULT_PARAMS):
+    """ Grows the dataset at path to num_rows rows, creating it if need
+        be. Rows are appended as a separately pickled chunk, so existing
+        rows are neither rewritten nor regenerated. """
+    manifest = read_manifest(path)
+    have = manifest['num_rows'] if manifest is not None else 0
+    if have >= num_rows:
+        return
+    rows = generate_rows(num_rows - have, params, offset=have)
 
     print('Serializing data to disk')
-    with open(path, 'w') as f:
-        pickle.dump(rows, f)
+    with open(path, 'ab' if have else 'wb') as f:
+        pickle.dump(rows, f, pickle.HIGHEST_PROTOCOL)
+    write_manifest(path, params, num_rows)
+
+
+def load_rows(path, limit=None):
+    """ Reads up to limit rows from a dataset, chunk by chunk. """
+    rows = []
+    with open(path, 'rb') as f:
+        while limit is None or len(rows) < limit:
+            try:
+                rows.extend(pickle.load(f))
+            except EOFError:
+                break
+    return rows[:limit] if limit is not None else rows
+
+
+def main(scale_factor=100000, path=None, params=DEFAULT_PARAMS):
+    if path is None:
+        path = join(dirname(abspath(__file__)), dataset_name(params))
+    extend_dataset(path, scale_factor, params)
 
 
 if __name__ == '__main__':
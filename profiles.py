@@ -0,0 +1,189 @@
+# Workload profiles
+# Each profile bundles the table layout, how a generated Row maps onto
+# it, and the upsert to run, for both MemSQL and Cassandra, so the
+# effect of schema choices on upsert throughput can be measured.
+
+from collections import namedtuple
+
+
+Profile = namedtuple('Profile', [
+    'name',
+    'description',
+    'memsql_ddl',          # statements, formatted with %(table)s
+    'memsql_columns',      # columns given in the insert
+    'memsql_update',       # on duplicate key clause, '' for a plain insert
+    'values',              # Row -> values for memsql_columns
+    'cassandra_ddl',       # statements, or None if the layout has no equivalent
+    'cassandra_update',    # (keyspace, table, Row) -> statement
+    'cassandra_batch_type',
+])
+
+
+PRIMARY_KEY_COLS = ['timestamp_of_data', 'customer_code', 'subcustomer_id',
+                    'geographic_region', 'billing_flag', 'ip_address']
+
+BASE_COLUMNS = ['customer_code', 'subcustomer_id', 'geographic_region',
+                'billing_flag', 'ip_address', 'bytes', 'hits']
+
+WIDE_COUNTERS = ['counter_%d' % i for i in range(16)]
+
+
+def base_values(row):
+    return (row.customer_code, row.subcustomer_id, row.geographic_region,
+            row.billing_flag, row.ip_address, row.bytes, row.hits)
+
+
+def wide_values(row):
+    # Spread the row's traffic over the counters so each gets a
+    # different, but deterministic, increment.
+    return base_values(row)[:5] + tuple(
+        (row.bytes >> i) + row.hits for i in range(len(WIDE_COUNTERS)))
+
+
+def where_clause(row, cols=PRIMARY_KEY_COLS):
+    return 'where ' + ' and '.join(['%s=%r' % (name, getattr(row, name))
+                                    for name in cols])
+
+
+def counter_update(keyspace, table, row):
+    return ('update %s.%s set hits = hits + 1 ' % (keyspace, table) +
+            where_clause(row) + ';')
+
+
+def wide_counter_update(keyspace, table, row):
+    increments = ', '.join('%s = %s + %d' % (name, name, value) for name, value
+                           in zip(WIDE_COUNTERS, wide_values(row)[5:]))
+    return ('update %s.%s set %s ' % (keyspace, table, increments) +
+            where_clause(row) + ';')
+
+
+def plain_insert(keyspace, table, row):
+    cols = PRIMARY_KEY_COLS + ['bytes', 'hits']
+    return 'insert into %s.%s (%s) values (%s);' % (
+        keyspace, table, ', '.join(cols),
+        ', '.join('%r' % getattr(row, name) for name in cols))
+
+
+MEMSQL_BASE_COLUMNS = (
+    'customer_code int unsigned not null, '
+    'timestamp_of_data timestamp default current_timestamp, '
+    'subcustomer_id char(12), '
+    'geographic_region int unsigned not null, '
+    'billing_flag int unsigned not null, '
+    'ip_address char(20), ')
+
+MEMSQL_PRIMARY_KEY = ('primary key (timestamp_of_data, customer_code, '
+                      'subcustomer_id, geographic_region, billing_flag, '
+                      'ip_address)')
+
+MEMSQL_BASE_UPDATE = ('on duplicate key update bytes = values(bytes) + bytes, '
+                      'hits = values(hits) + hits')
+
+CASSANDRA_BASE_COLUMNS = (
+    'customer_code int, timestamp_of_data timestamp,'
+    'subcustomer_id varchar, geographic_region int,'
+    'billing_flag int, ip_address varchar,')
+
+
+PROFILES = dict((profile.name, profile) for profile in [
+    Profile(
+        name='rowstore',
+        description='composite primary key led by timestamp_of_data',
+        memsql_ddl=[
+            'create table if not exists %(table)s (' + MEMSQL_BASE_COLUMNS +
+            'bytes bigint unsigned not null, '
+            'hits bigint unsigned not null, ' + MEMSQL_PRIMARY_KEY + ')'],
+        memsql_columns=BASE_COLUMNS,
+        memsql_update=MEMSQL_BASE_UPDATE,
+        values=base_values,
+        cassandra_ddl=[
+            'create table if not exists %(table)s (' + CASSANDRA_BASE_COLUMNS +
+            'hits counter, primary key (timestamp_of_data, '
+            'customer_code, subcustomer_id, geographic_region, '
+            'billing_flag, ip_address))'],
+        cassandra_update=counter_update,
+        cassandra_batch_type='COUNTER',
+    ),
+    Profile(
+        name='sharded',
+        description='rows hash-sharded (partitioned) on customer_code',
+        memsql_ddl=[
+            'create table if not exists %(table)s (' + MEMSQL_BASE_COLUMNS +
+            'bytes bigint unsigned not null, '
+            'hits bigint unsigned not null, '
+            'primary key (customer_code, timestamp_of_data, subcustomer_id, '
+            'geographic_region, billing_flag, ip_address), '
+            'shard key (customer_code))'],
+        memsql_columns=BASE_COLUMNS,
+        memsql_update=MEMSQL_BASE_UPDATE,
+        values=base_values,
+        cassandra_ddl=[
+            'create table if not exists %(table)s (' + CASSANDRA_BASE_COLUMNS +
+            'hits counter, primary key ((customer_code), timestamp_of_data, '
+            'subcustomer_id, geographic_region, billing_flag, ip_address))'],
+        cassandra_update=counter_update,
+        cassandra_batch_type='COUNTER',
+    ),
+    Profile(
+        name='wide',
+        description='%d counters updated by every upsert' % len(WIDE_COUNTERS),
+        memsql_ddl=[
+            'create table if not exists %(table)s (' + MEMSQL_BASE_COLUMNS +
+            ''.join('%s bigint unsigned not null, ' % name
+                    for name in WIDE_COUNTERS) + MEMSQL_PRIMARY_KEY + ')'],
+        memsql_columns=BASE_COLUMNS[:5] + WIDE_COUNTERS,
+        memsql_update='on duplicate key update ' + ', '.join(
+            '%s = values(%s) + %s' % (name, name, name) for name in WIDE_COUNTERS),
+        values=wide_values,
+        cassandra_ddl=[
+            'create table if not exists %(table)s (' + CASSANDRA_BASE_COLUMNS +
+            ''.join('%s counter, ' % name for name in WIDE_COUNTERS) +
+            'primary key (timestamp_of_data, customer_code, subcustomer_id, '
+            'geographic_region, billing_flag, ip_address))'],
+        cassandra_update=wide_counter_update,
+        cassandra_batch_type='COUNTER',
+    ),
+    Profile(
+        name='indexed',
+        description='rowstore layout plus secondary indexes',
+        memsql_ddl=[
+            'create table if not exists %(table)s (' + MEMSQL_BASE_COLUMNS +
+            'bytes bigint unsigned not null, '
+            'hits bigint unsigned not null, ' + MEMSQL_PRIMARY_KEY + ', '
+            'key (subcustomer_id), key (ip_address), '
+            'key (geographic_region, billing_flag))'],
+        memsql_columns=BASE_COLUMNS,
+        memsql_update=MEMSQL_BASE_UPDATE,
+        values=base_values,
+        # Cassandra can't index counter tables, so this variant stores
+        # plain columns and its upserts overwrite instead of adding.
+        cassandra_ddl=[
+            'create table if not exists %(table)s (' + CASSANDRA_BASE_COLUMNS +
+            'bytes bigint, hits bigint, primary key (timestamp_of_data, '
+            'customer_code, subcustomer_id, geographic_region, '
+            'billing_flag, ip_address))',
+            'create index if not exists on %(table)s (subcustomer_id)',
+            'create index if not exists on %(table)s (ip_address)'],
+        cassandra_update=plain_insert,
+        cassandra_batch_type='UNLOGGED',
+    ),
+    Profile(
+        name='columnstore',
+        description='clustered columnstore; upserts become appends',
+        memsql_ddl=[
+            'create table if not exists %(table)s (' + MEMSQL_BASE_COLUMNS +
+            'bytes bigint unsigned not null, '
+            'hits bigint unsigned not null, '
+            'key (timestamp_of_data, customer_code) using clustered columnstore, '
+            'shard key (customer_code))'],
+        memsql_columns=BASE_COLUMNS,
+        # columnstore tables have no unique keys to update against
+        memsql_update='',
+        values=base_values,
+        cassandra_ddl=None,
+        cassandra_update=None,
+        cassandra_batch_type=None,
+    ),
+])
+
+DEFAULT_PROFILE = 'rowstore'
@@ -0,0 +1,461 @@
+# Telemetry collected alongside a benchmark run
+# Samples the client process from /proc so a run that was limited by
+# the client, rather than the database, can be recognized as such,
+# and polls the database so throughput dips can be matched to what
+# the server was doing at the time.
+
+import os
+import socket
+import threading
+import time
+
+
+# A thread (or the whole process) busier than this fraction of the
+# cores available to it is considered saturated.
+SATURATION_THRESHOLD = 0.9
+
+# Python threads take turns holding the GIL, so a client whose upserts
+# are issued by python threads can use about one core in total no
+# matter how many threads it runs.
+GIL_CORES = 1
+
+
+def read_file(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def read_thread_times(pid='self'):
+    """ Returns {tid: (name, utime, stime)} for every thread of the
+        process, with times in clock ticks. """
+    times = {}
+    task_dir = '/proc/%s/task' % pid
+    for tid in os.listdir(task_dir):
+        try:
+            stat = read_file('%s/%s/stat' % (task_dir, tid))
+        except IOError:
+            continue  # thread exited between listdir and open
+        # the thread name is parenthesized and may contain spaces
+        name = stat[stat.index('(') + 1:stat.rindex(')')]
+        fields = stat[stat.rindex(')') + 2:].split()
+        times[tid] = (name, int(fields[11]), int(fields[12]))
+    return times
+
+
+def read_status(pid='self'):
+    """ Returns the RSS (bytes) and context switch counters
+        of the process. """
+    status = {}
+    for line in read_file('/proc/%s/status' % pid).splitlines():
+        key, _, value = line.partition(':')
+        status[key] = value.split()
+    return {
+        'rss': int(status['VmRSS'][0]) * 1024,
+        'voluntary_ctxt_switches': int(status['voluntary_ctxt_switches'][0]),
+        'nonvoluntary_ctxt_switches': int(status['nonvoluntary_ctxt_switches'][0]),
+    }
+
+
+def read_net_bytes(pid='self'):
+    """ Returns (rx_bytes, tx_bytes) summed over all non-loopback
+        interfaces. These counters belong to the network namespace,
+        not the process, so other traffic on the host is included. """
+    rx = tx = 0
+    for line in read_file('/proc/%s/net/dev' % pid).splitlines()[2:]:
+        iface, _, counters = line.partition(':')
+        if iface.strip() == 'lo':
+            continue
+        counters = counters.split()
+        rx += int(counters[0])
+        tx += int(counters[8])
+    return rx, tx
+
+
+class ClientSampler(threading.Thread):
+    """ Samples CPU per thread, RSS, context switches and network
+        bytes of this process once per interval. Each sample holds
+        rates over the preceding interval. """
+
+    def __init__(self, interval=1.0, cpu_limit=GIL_CORES):
+        """ cpu_limit is the number of cores the client can keep busy:
+            GIL_CORES for python threads, all of them when the driver
+            does its work outside the GIL. """
+        super(ClientSampler, self).__init__()
+        self.daemon = True
+        self.interval = interval
+        self.cpu_limit = cpu_limit
+        self.stopping = threading.Event()
+        self.samples = []
+        self.num_cpus = os.sysconf('SC_NPROCESSORS_ONLN')
+        self.clock_ticks = float(os.sysconf('SC_CLK_TCK'))
+        self.supported = os.path.isdir('/proc/self/task')
+
+    def snapshot(self):
+        return {
+            'time': time.time(),
+            'threads': read_thread_times(),
+            'status': read_status(),
+            'net': read_net_bytes(),
+        }
+
+    def diff(self, prev, cur):
+        elapsed = cur['time'] - prev['time']
+        ticks = self.clock_ticks * elapsed
+        threads = {}
+        for tid, (name, utime, stime) in cur['threads'].items():
+            # threads born during the interval started from zero
+            _, prev_utime, prev_stime = prev['threads'].get(tid, (name, 0, 0))
+            threads[tid] = {
+                'name': name,
+                'user': (utime - prev_utime) / ticks,
+                'sys': (stime - prev_stime) / ticks,
+            }
+        status, prev_status = cur['status'], prev['status']
+        return {
+            'time': cur['time'],
+            'threads': threads,
+            # cpu values are fractions of one core
+            'cpu': sum(t['user'] + t['sys'] for t in threads.values()),
+            'rss': status['rss'],
+            'voluntary_ctxt_switches': (status['voluntary_ctxt_switches'] -
+                prev_status['voluntary_ctxt_switches']) / elapsed,
+            'nonvoluntary_ctxt_switches': (status['nonvoluntary_ctxt_switches'] -
+                prev_status['nonvoluntary_ctxt_switches']) / elapsed,
+            'net_rx': (cur['net'][0] - prev['net'][0]) / elapsed,
+            'net_tx': (cur['net'][1] - prev['net'][1]) / elapsed,
+        }
+
+    def run(self):
+        if not self.supported:
+            return
+        prev = self.snapshot()
+        while not self.stopping.wait(self.interval):
+            cur = self.snapshot()
+            self.samples.append(self.diff(prev, cur))
+            prev = cur
+
+    def stop(self):
+        self.stopping.set()
+        if self.is_alive():
+            self.join()
+
+    def summary(self):
+        """ Condenses the samples into a dict that can be serialized
+            and merged with the summaries of other hosts. Returns None
+            when nothing was sampled. """
+        if not self.samples:
+            return None
+        n = len(self.samples)
+        peak_thread_cpu = 0
+        # cpu of each thread summed over the samples, by tid
+        thread_totals, thread_names = {}, {}
+        for sample in self.samples:
+            for tid, thread in sample['threads'].items():
+                cpu = thread['user'] + thread['sys']
+                peak_thread_cpu = max(peak_thread_cpu, cpu)
+                thread_totals[tid] = thread_totals.get(tid, 0) + cpu
+                thread_names[tid] = thread['name']
+        # Averaged over the whole run, so a thread that was busy for a
+        # single second doesn't count as saturated.
+        busiest_tid = max(thread_totals, key=thread_totals.get)
+
+        summary = {
+            'host': socket.gethostname(),
+            'samples': n,
+            'num_cpus': self.num_cpus,
+            'cpu_limit': self.cpu_limit,
+            'avg_cpu': sum(s['cpu'] for s in self.samples) / n,
+            'peak_cpu': max(s['cpu'] for s in self.samples),
+            'avg_user': sum(sum(t['user'] for t in s['threads'].values())
+                            for s in self.samples) / n,
+            'avg_sys': sum(sum(t['sys'] for t in s['threads'].values())
+                           for s in self.samples) / n,
+            'peak_thread_cpu': peak_thread_cpu,
+            'busiest_thread': thread_names[busiest_tid],
+            'busiest_thread_cpu': thread_totals[busiest_tid] / n,
+            'peak_rss': max(s['rss'] for s in self.samples),
+            'avg_voluntary_ctxt_switches': sum(
+                s['voluntary_ctxt_switches'] for s in self.samples) / n,
+            'avg_nonvoluntary_ctxt_switches': sum(
+                s['nonvoluntary_ctxt_switches'] for s in self.samples) / n,
+            'avg_net_rx': sum(s['net_rx'] for s in self.samples) / n,
+            'avg_net_tx': sum(s['net_tx'] for s in self.samples) / n,
+        }
+        summary['saturation'] = saturation_reasons(summary)
+        return summary
+
+
+def saturation_reasons(summary):
+    """ Returns a list of reasons to believe the client, not the
+        database, bounded the run. Empty if there are none. """
+    reasons = []
+    cpu_limit = min(summary['cpu_limit'], summary['num_cpus'])
+    if summary['avg_cpu'] >= SATURATION_THRESHOLD * cpu_limit:
+        if cpu_limit == GIL_CORES:
+            reasons.append('process averaged %.0f%% of one core, the most '
+                           'python threads get under the GIL' % (
+                               100 * summary['avg_cpu']))
+        else:
+            reasons.append('process averaged %.0f%% of %d cores' % (
+                100 * summary['avg_cpu'], cpu_limit))
+    if summary['busiest_thread_cpu'] >= SATURATION_THRESHOLD:
+        # Upsert threads should mostly wait on the database. One that
+        # keeps a core busy is doing python work.
+        reasons.append('thread %s averaged %.0f%% of a core' % (
+            summary['busiest_thread'], 100 * summary['busiest_thread_cpu']))
+    return reasons
+
+
+def format_client_summary(summary):
+    lines = [
+        '%s: cpu avg %.0f%% (user %.0f%%, sys %.0f%%), peak %.0f%% of one core, '
+        'busiest thread avg %.0f%%, peak %.0f%%' % (
+            summary['host'], 100 * summary['avg_cpu'],
+            100 * summary['avg_user'], 100 * summary['avg_sys'],
+            100 * summary['peak_cpu'], 100 * summary['busiest_thread_cpu'],
+            100 * summary['peak_thread_cpu']),
+        '    peak rss %.1f MB, %d voluntary / %d involuntary ctx switches/s, '
+        'net rx %.1f MB/s tx %.1f MB/s' % (
+            summary['peak_rss'] / float(1024 ** 2),
+            summary['avg_voluntary_ctxt_switches'],
+            summary['avg_nonvoluntary_ctxt_switches'],
+            summary['avg_net_rx'] / float(1024 ** 2),
+            summary['avg_net_tx'] / float(1024 ** 2)),
+    ]
+    for reason in summary['saturation']:
+        lines.append('    WARNING: client saturated, %s' % reason)
+    return '\n'.join(lines)
+
+
+# Status variables shown next to throughput dips when the server
+# reports them, in addition to whatever changed the most.
+MEMSQL_STATUS_HIGHLIGHTS = ['Total_server_memory', 'Alloc_table_memory',
+                            'Threads_running', 'Queries']
+
+
+def to_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def poll_memsql(conn, database, table):
+    status = {}
+    for row in conn.query('show status extended'):
+        value = to_number(row['Value'])
+        if value is not None:
+            status[row['Variable_name']] = value
+
+    partitions = conn.query(
+        'select partition_type, rows, memory_use '
+        'from information_schema.table_statistics '
+        'where database_name = %s and table_name = %s', database, table)
+    memory = [int(p['memory_use']) for p in partitions]
+    return {
+        'status': status,
+        # replicas hold copies of their master's rows, but memory of their own
+        'rows': sum(int(p['rows']) for p in partitions
+                    if p['partition_type'] == 'Master'),
+        'memory': sum(memory),
+        'max_partition_memory': max(memory) if memory else 0,
+    }
+
+
+def poll_cassandra(session, keyspace, table):
+    estimates = list(session.execute(
+        'select partitions_count, mean_partition_size from system.size_estimates '
+        'where keyspace_name = %s and table_name = %s', (keyspace, table)))
+    compactions = [c for c in session.execute(
+        'select keyspace_name, columnfamily_name, bytes_in, bytes_out '
+        'from system.compaction_history')
+        if c.keyspace_name == keyspace and c.columnfamily_name == table]
+    rows = sum(e.partitions_count for e in estimates)
+    return {
+        'status': {
+            'compactions': len(compactions),
+            'compacted_bytes_in': sum(c.bytes_in for c in compactions),
+            'compacted_bytes_out': sum(c.bytes_out for c in compactions),
+        },
+        'rows': rows,
+        'memory': sum(e.partitions_count * e.mean_partition_size
+                      for e in estimates),
+        'max_partition_memory': max([e.mean_partition_size
+                                     for e in estimates] or [0]),
+    }
+
+
+class ServerMetricsCollector(threading.Thread):
+    """ Polls server status and table statistics at a fixed interval.
+        Samples are timestamped with time.time() so they line up with
+        the client throughput timeline. """
+
+    def __init__(self, connect, use_cassandra, database, table, interval):
+        super(ServerMetricsCollector, self).__init__()
+        self.daemon = True
+        self.connect = connect
+        self.poll = poll_cassandra if use_cassandra else poll_memsql
+        self.database = database
+        self.table = table
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.samples = []
+        self.errors = 0
+
+    def run(self):
+        with self.connect() as conn:
+            while True:
+                try:
+                    sample = self.poll(conn, self.database, self.table)
+                    sample['time'] = time.time()
+                    self.samples.append(sample)
+                except Exception as e:
+                    # A failed poll must not end the benchmark
+                    self.errors += 1
+                    if self.errors == 1:
+                        print('Server metrics poll failed: %s' % e)
+                if self.stopping.wait(self.interval):
+                    break
+
+    def stop(self):
+        self.stopping.set()
+        if self.is_alive():
+            self.join()
+
+
+def nearest(timeline, t):
+    """ Returns the entry of a (time, value) timeline closest to t. """
+    return min(timeline, key=lambda entry: abs(entry[0] - t))
+
+
+def format_server_timeline(samples, throughput, start_time):
+    """ Renders server samples side by side with the client throughput
+        measured closest to each of them, marking throughput dips and
+        the status counters that moved the most around them. """
+    if not samples:
+        return ''
+    rates = sorted(rate for _, rate in throughput)
+    median_rate = rates[len(rates) // 2] if rates else 0
+    lines = ['%8s %14s %14s %12s  %s' % (
+        'time (s)', 'client rows/s', 'table rows', 'memory (MB)', 'notes')]
+    prev = None
+    for sample in samples:
+        rate = nearest(throughput, sample['time'])[1] if throughput else 0
+        notes = ''
+        if prev is not None and median_rate and rate < median_rate / 2:
+            notes = 'DIP: ' + ', '.join(status_changes(prev, sample))
+        lines.append('%8.1f %14s %14s %12.1f  %s' % (
+            sample['time'] - start_time, '{:,}'.format(int(rate)),
+            '{:,}'.format(sample['rows']),
+            sample['memory'] / float(1024 ** 2), notes))
+        prev = sample
+    return '\n'.join(lines)
+
+
+def status_changes(prev, cur, limit=3):
+    changes = []
+    for name, value in cur['status'].items():
+        before = prev['status'].get(name)
+        if before is None or value == before:
+            continue
+        relative = abs(value - before) / max(abs(before), 1.0)
+        changes.append((name in MEMSQL_STATUS_HIGHLIGHTS, relative, name, before, value))
+    changes.sort(reverse=True)
+    return ['%s %g -> %g' % (name, before, value)
+            for _, _, name, before, value in changes[:limit]]
+
+
+def format_growth_plot(samples, throughput, width=60, height=12):
+    """ Plots client throughput (y) against the table size reported by
+        the server (x) as text. Each column shows the average throughput
+        seen while the table was within its range of sizes. """
+    points = [(s['rows'], nearest(throughput, s['time'])[1])
+              for s in samples if throughput]
+    if not points:
+        return ''
+    max_rows = max(rows for rows, _ in points) or 1
+    columns = [[] for _ in range(width)]
+    for rows, rate in points:
+        columns[min(width - 1, rows * width // max_rows)].append(rate)
+    averages = [sum(c) / len(c) if c else None for c in columns]
+    max_rate = max(a for a in averages if a is not None) or 1
+
+    label_width = len('{:,}'.format(int(max_rate)))
+    lines = []
+    for level in range(height, 0, -1):
+        threshold = max_rate * (level - 0.5) / height
+        label = '{:,}'.format(int(max_rate * level / height)) if level in (height, 1) else ''
+        lines.append('%*s |%s' % (label_width, label, ''.join(
+            '*' if a is not None and a >= threshold else ' ' for a in averages)))
+    lines.append('%*s +%s' % (label_width, '', '-' * width))
+    lines.append('%*s  0%s' % (label_width, '', '{:,} rows'.format(max_rows).rjust(width - 1)))
+    return '\n'.join(lines)
+
+
+# Workers, hosts or endpoints slower than this fraction of the median
+# are reported as stragglers.
+STRAGGLER_FRACTION = 0.8
+
+SPARK_LEVELS = ' .:-=+*#%@'
+
+
+def fairness(values):
+    """ Returns Jain's fairness index (1 when all values are equal,
+        1/n when one value has everything) and the coefficient of
+        variation of values. """
+    n = len(values)
+    total = float(sum(values))
+    squares = sum(v * v for v in values)
+    if not n or not squares:
+        return 1.0, 0.0
+    mean = total / n
+    std = (sum((v - mean) ** 2 for v in values) / n) ** 0.5
+    return total * total / (n * squares), std / mean
+
+
+def sparkline(series, scale):
+    return ''.join(SPARK_LEVELS[0] if not v else
+                   SPARK_LEVELS[max(1, int(round(v * (len(SPARK_LEVELS) - 1) / scale)))]
+                   for v in series)
+
+
+def format_timelines(timelines, width=60):
+    """ Renders the per-second rows of each named timeline
+        ({epoch second: rows}) as rates, sparklines on a common scale,
+        a fairness summary and the stragglers among them. """
+    seconds = [s for _, buckets in timelines for s in buckets]
+    if not seconds:
+        return ''
+    first, last = min(seconds), max(seconds)
+    span = last - first + 1
+    # seconds per sparkline column
+    step = -(-span // width)
+
+    series = []
+    for name, buckets in timelines:
+        per_second = [buckets.get(s, 0) for s in range(first, last + 1)]
+        columns = [sum(per_second[i:i + step]) for i in range(0, span, step)]
+        series.append((name, per_second, columns))
+    scale = max(max(columns) for _, _, columns in series) or 1
+
+    rates = [sum(per_second) / float(span) for _, per_second, _ in series]
+    median = sorted(rates)[len(rates) // 2]
+    stragglers = [name for (name, _, _), rate in zip(series, rates)
+                  if rate < STRAGGLER_FRACTION * median]
+
+    name_width = max(len(name) for name, _, _ in series)
+    lines = []
+    for (name, per_second, columns), rate in zip(series, rates):
+        idle = sum(1 for rows in per_second if not rows)
+        lines.append('%-*s %12s rows/s  idle %4d s |%s|%s' % (
+            name_width, name, '{:,}'.format(int(rate)), idle,
+            sparkline(columns, scale),
+            '  STRAGGLER' if name in stragglers else ''))
+    jain, cv = fairness(rates)
+    lines.append('%d s per column; fairness (Jain) %.3f, coefficient of '
+                 'variation %.3f' % (step, jain, cv))
+    if stragglers:
+        lines.append('Stragglers (below %d%% of the median %s rows/s): %s' % (
+            100 * STRAGGLER_FRACTION, '{:,}'.format(int(median)),
+            ', '.join(stragglers)))
+    return '\n'.join(lines)
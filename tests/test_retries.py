@@ -0,0 +1,241 @@
+import os
+import sys
+import threading
+import time
+import types
+import unittest
+
+
+def stub_module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+
+# benchmark imports both database drivers at load time. The workers only
+# need their exception types and database.connect, which the tests
+# replace anyway, so stand in for whichever driver isn't installed.
+try:
+    from memsql.common import database
+except ImportError:
+    class MySQLError(Exception):
+        pass
+    database = stub_module('memsql.common.database', MySQLError=MySQLError,
+                           connect=None)
+    stub_module('memsql', common=stub_module('memsql.common', database=database))
+
+try:
+    import cassandra.cluster
+    import cassandra.policies
+    import cassandra.query
+except ImportError:
+    stub_module('cassandra',
+                DriverException=type('DriverException', (Exception,), {}),
+                RequestExecutionException=type('RequestExecutionException',
+                                               (Exception,), {}))
+    stub_module('cassandra.cluster', Cluster=object,
+                NoHostAvailable=type('NoHostAvailable', (Exception,), {}))
+    stub_module('cassandra.policies', WhiteListRoundRobinPolicy=object)
+    stub_module('cassandra.query', BatchStatement=object, SimpleStatement=object,
+                BatchType=object)
+
+import benchmark
+
+
+def lost_connection():
+    return database.MySQLError(2013, 'Lost connection to MySQL server during query')
+
+
+def cannot_connect():
+    return database.MySQLError(2003, "Can't connect to MySQL server")
+
+
+class CannedServer(object):
+    """ Decides what the stand-in connections do. Every query takes the
+        next of outcomes, an exception to raise or None to succeed, and
+        every connect takes the next of connects the same way. Once they
+        run out, queries fail with failure (if given), and connects
+        succeed. Each query takes delay seconds. """
+
+    def __init__(self, outcomes=(), connects=(), failure=None, delay=0):
+        self.outcomes = list(outcomes)
+        self.connects = list(connects)
+        self.failure = failure
+        self.delay = delay
+        self.conns = []
+        self.lock = threading.Lock()
+
+    def connect(self, **kwargs):
+        with self.lock:
+            outcome = self.connects.pop(0) if self.connects else None
+        if outcome is not None:
+            raise outcome
+        conn = CannedConnection(self)
+        with self.lock:
+            self.conns.append(conn)
+        return conn
+
+    def answer(self):
+        time.sleep(self.delay)
+        with self.lock:
+            outcome = self.outcomes.pop(0) if self.outcomes else None
+        if outcome is not None:
+            raise outcome
+        if self.failure is not None:
+            raise self.failure()
+
+
+class CannedDB(object):
+    """ The non-blocking half of a connection the pipelined engine
+        drives, readable through a pipe once a query was sent. """
+
+    def __init__(self, server):
+        self.server = server
+        self.read_end, self.write_end = os.pipe()
+
+    def fileno(self):
+        return self.read_end
+
+    def send_query(self, query):
+        os.write(self.write_end, 'q')
+
+    def read_query_result(self):
+        os.read(self.read_end, 1)
+        self.server.answer()
+
+
+class CannedConnection(object):
+
+    def __init__(self, server):
+        self.server = server
+        self.queries = 0
+        self.closed = False
+        self._db = CannedDB(server)
+
+    def execute(self, query):
+        self.queries += 1
+        self.server.answer()
+
+    def close(self):
+        self.closed = True
+        os.close(self._db.read_end)
+        os.close(self._db.write_end)
+
+
+class RetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (sys.argv, benchmark.NUM_WORKERS, benchmark.ANALYTICS,
+                      getattr(benchmark, 'options', None), database.connect,
+                      benchmark.load_rows)
+        sys.argv = ['benchmark.py', '--retries=2', '--retry-backoff=0.001']
+        benchmark.options = self.options = benchmark.parse_args()
+        benchmark.NUM_WORKERS = 2
+        benchmark.ANALYTICS = self.analytics = benchmark.Analytics()
+        # keep the running throughput lines out of the test output
+        self.analytics.report_frequency = sys.maxint
+        self.stopping = threading.Event()
+
+    def tearDown(self):
+        (sys.argv, benchmark.NUM_WORKERS, benchmark.ANALYTICS, benchmark.options,
+         database.connect, benchmark.load_rows) = self.saved
+
+    def serve(self, server):
+        database.connect = server.connect
+        return server
+
+    def worker(self):
+        return benchmark.InsertWorker(self.stopping, ['upsert'], 0, 500)
+
+    def test_retry_then_success(self):
+        server = self.serve(CannedServer(
+            outcomes=[database.MySQLError(1213, 'Deadlock found')]))
+        conns = [server.connect()]
+
+        latency = self.worker().execute(conns, 0, 'upsert', 500)
+
+        self.assertNotEqual(latency, None)
+        self.assertEqual(conns[0].queries, 2)
+        self.assertEqual(self.analytics.errors, {'MySQLError(1213)': 1})
+        self.assertEqual(self.analytics.retried_rows, 500)
+        self.assertEqual(self.analytics.failed_rows, 0)
+
+    def test_exhausted_retries_fail_the_batch(self):
+        server = self.serve(CannedServer(
+            failure=lambda: database.MySQLError(1213, 'Deadlock found')))
+        conns = [server.connect()]
+
+        latency = self.worker().execute(conns, 0, 'upsert', 500)
+
+        self.assertEqual(latency, None)
+        # the first try and both retries
+        self.assertEqual(conns[0].queries, 3)
+        self.assertEqual(self.analytics.errors, {'MySQLError(1213)': 3})
+        self.assertEqual(self.analytics.retried_rows, 1000)
+        self.assertEqual(self.analytics.failed_rows, 500)
+
+    def test_reconnect_after_lost_connection(self):
+        server = self.serve(CannedServer(outcomes=[lost_connection()]))
+        lost = server.connect()
+        # the first reconnect fails too, and costs an attempt
+        server.connects = [cannot_connect()]
+        conns = [lost]
+
+        latency = self.worker().execute(conns, 0, 'upsert', 500)
+
+        self.assertNotEqual(latency, None)
+        self.assertTrue(lost.closed)
+        self.assertEqual(len(server.conns), 2)
+        self.assertTrue(conns[0] is server.conns[1])
+        self.assertEqual(conns[0].queries, 1)
+        self.assertEqual(self.analytics.errors,
+                         {'MySQLError(2013)': 1, 'MySQLError(2003)': 1})
+        self.assertEqual(self.analytics.failed_rows, 0)
+
+    def test_pipelined_reconnect_after_lost_connection(self):
+        server = self.serve(CannedServer(outcomes=[lost_connection()],
+                                         connects=[None, None, cannot_connect()]))
+        worker = benchmark.PipelinedWorker(self.stopping, ['upsert'], 0, 500, 2)
+        worker.start()
+        time.sleep(0.2)
+        self.stopping.set()
+        worker.join(5)
+
+        self.assertFalse(worker.is_alive())
+        self.assertEqual(worker.exception, None)
+        self.assertEqual(len(server.conns), 3)
+        self.assertEqual([conn.closed for conn in server.conns], [True] * 3)
+        self.assertEqual(self.analytics.errors,
+                         {'MySQLError(2013)': 1, 'MySQLError(2003)': 1})
+        self.assertEqual(self.analytics.failed_rows, 0)
+        self.assertTrue(sum(self.analytics.upsert_counts) > 0)
+
+    def test_stalled_server_stops_at_workload_time(self):
+        # Every query hangs for a while, then loses its connection, and
+        # the server refuses new ones: workers keep backing off, but must
+        # still let the run end on time.
+        self.serve(CannedServer(connects=[None, None], delay=0.2,
+                                failure=lost_connection))
+        self.options.retries = 1000
+        self.options.retry_backoff = 1
+        self.options.workload_time = 1
+        row = benchmark.Row(customer_code=1, timestamp_of_data=0,
+                            subcustomer_id='A', geographic_region=1,
+                            billing_flag=1, ip_address='1.2.3.4', bytes=1, hits=1)
+        benchmark.load_rows = lambda options: [row] * 1000
+
+        started = time.time()
+        benchmark.run_benchmark(self.options)
+
+        self.assertTrue(time.time() - started < self.options.workload_time + 2)
+        self.assertEqual(self.analytics.dead_workers, [])
+        self.assertEqual(sum(self.analytics.upsert_counts), 0)
+        # batches cut off by the end of the run count as failed
+        self.assertEqual(self.analytics.failed_rows, 1000)
+        # starved workers still get a (flat) timeline
+        self.assertEqual(self.analytics.local_buckets(), {0: {}, 1: {}})
+
+
+if __name__ == '__main__':
+    unittest.main()
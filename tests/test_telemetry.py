@@ -0,0 +1,173 @@
+import time
+import unittest
+from collections import namedtuple
+
+import telemetry
+
+
+STATUS = [
+    {'Variable_name': 'Alloc_table_memory', 'Value': '1048576'},
+    {'Variable_name': 'Threads_running', 'Value': '4'},
+    {'Variable_name': 'Uptime', 'Value': '120'},
+    {'Variable_name': 'Version_comment', 'Value': 'MemSQL source distribution'},
+]
+
+TABLE_STATISTICS = [
+    {'partition_type': 'Master', 'rows': 1000, 'memory_use': 200000},
+    {'partition_type': 'Master', 'rows': 3000, 'memory_use': 500000},
+    # replicas of the above, under high availability
+    {'partition_type': 'Slave', 'rows': 1000, 'memory_use': 210000},
+    {'partition_type': 'Slave', 'rows': 3000, 'memory_use': 490000},
+]
+
+SizeEstimate = namedtuple('SizeEstimate', ['partitions_count', 'mean_partition_size'])
+Compaction = namedtuple('Compaction', ['keyspace_name', 'columnfamily_name',
+                                       'bytes_in', 'bytes_out'])
+
+
+class CannedMemSQL(object):
+    """ Stands in for a memsql connection, serving canned status. """
+
+    def __init__(self, status=STATUS, table_statistics=TABLE_STATISTICS):
+        self.status = status
+        self.table_statistics = table_statistics
+        self.queries = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def query(self, sql, *args):
+        self.queries.append((sql, args))
+        if sql == 'show status extended':
+            return self.status
+        if 'information_schema.table_statistics' in sql:
+            return self.table_statistics
+        raise AssertionError('unexpected query: %s' % sql)
+
+
+class CannedCassandra(object):
+    """ Stands in for a cassandra session, serving canned system tables. """
+
+    def __init__(self):
+        self.params = []
+
+    def execute(self, cql, params=None):
+        self.params.append(params)
+        if 'system.size_estimates' in cql:
+            return [SizeEstimate(100, 400), SizeEstimate(300, 200)]
+        if 'system.compaction_history' in cql:
+            return [Compaction('perfdb', 'records', 5000, 4000),
+                    Compaction('perfdb', 'records', 1000, 900),
+                    Compaction('other', 'records', 7, 7)]
+        raise AssertionError('unexpected query: %s' % cql)
+
+
+class PollTest(unittest.TestCase):
+
+    def test_poll_memsql(self):
+        conn = CannedMemSQL()
+        sample = telemetry.poll_memsql(conn, 'perfdb', 'records')
+        # rows counted once, memory across replicas too
+        self.assertEqual(sample['rows'], 4000)
+        self.assertEqual(sample['memory'], 1400000)
+        self.assertEqual(sample['max_partition_memory'], 500000)
+        self.assertEqual(sample['status']['Alloc_table_memory'], 1048576)
+        self.assertEqual(sample['status']['Threads_running'], 4)
+        # only numeric status values are kept
+        self.assertNotIn('Version_comment', sample['status'])
+        self.assertEqual(conn.queries[1][1], ('perfdb', 'records'))
+
+    def test_poll_memsql_without_partitions(self):
+        sample = telemetry.poll_memsql(CannedMemSQL(table_statistics=[]),
+                                       'perfdb', 'records')
+        self.assertEqual((sample['rows'], sample['memory'],
+                          sample['max_partition_memory']), (0, 0, 0))
+
+    def test_poll_cassandra(self):
+        session = CannedCassandra()
+        sample = telemetry.poll_cassandra(session, 'perfdb', 'records')
+        self.assertEqual(sample['rows'], 400)
+        self.assertEqual(sample['memory'], 100 * 400 + 300 * 200)
+        self.assertEqual(sample['max_partition_memory'], 400)
+        # compactions of other tables are left out
+        self.assertEqual(sample['status'], {
+            'compactions': 2,
+            'compacted_bytes_in': 6000,
+            'compacted_bytes_out': 4900,
+        })
+        self.assertEqual(session.params[0], ('perfdb', 'records'))
+
+
+class ServerMetricsCollectorTest(unittest.TestCase):
+
+    def test_samples_are_timestamped(self):
+        before = time.time()
+        collector = telemetry.ServerMetricsCollector(
+            CannedMemSQL, False, 'perfdb', 'records', 0.01)
+        collector.start()
+        time.sleep(0.1)
+        collector.stop()
+        after = time.time()
+
+        times = [sample['time'] for sample in collector.samples]
+        self.assertTrue(len(times) >= 2)
+        self.assertEqual(times, sorted(times))
+        self.assertTrue(before <= times[0] and times[-1] <= after)
+        self.assertEqual(collector.errors, 0)
+
+    def test_failed_polls_are_counted(self):
+        def broken():
+            conn = CannedMemSQL()
+            conn.status = None  # iterating it fails
+            return conn
+        collector = telemetry.ServerMetricsCollector(
+            broken, False, 'perfdb', 'records', 0.01)
+        collector.start()
+        time.sleep(0.05)
+        collector.stop()
+        self.assertEqual(collector.samples, [])
+        self.assertTrue(collector.errors > 0)
+
+
+class ServerTimelineTest(unittest.TestCase):
+
+    def sample(self, t, alloc):
+        return {'time': t, 'rows': 10, 'memory': 1024 ** 2,
+                'status': {'Alloc_table_memory': alloc, 'Uptime': t}}
+
+    def test_dip_is_annotated(self):
+        samples = [self.sample(100 + i, 100) for i in range(4)]
+        samples.append(self.sample(104, 900))
+        throughput = [(100 + i, 1000) for i in range(4)] + [(104, 10)]
+        lines = telemetry.format_server_timeline(samples, throughput, 100).splitlines()
+
+        self.assertEqual(len(lines), 6)
+        for line in lines[1:5]:
+            self.assertNotIn('DIP', line)
+        self.assertIn('DIP', lines[5])
+        # the highlighted counter comes first
+        self.assertIn('DIP: Alloc_table_memory 100 -> 900', lines[5])
+
+    def test_no_samples(self):
+        self.assertEqual(telemetry.format_server_timeline([], [], 0), '')
+
+
+
+class TimelinesTest(unittest.TestCase):
+
+    def test_starved_worker_is_a_straggler(self):
+        busy = dict((100 + i, 500) for i in range(10))
+        lines = telemetry.format_timelines(
+            [('w/0', busy), ('w/1', dict(busy)), ('w/2', {})]).splitlines()
+
+        self.assertIn('STRAGGLER', lines[2])
+        self.assertIn('idle   10 s', lines[2])
+        self.assertIn('fairness (Jain) 0.667', lines[3])
+        self.assertTrue(lines[4].endswith(': w/2'))
+
+
+if __name__ == '__main__':
+    unittest.main()